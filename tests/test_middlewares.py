@@ -0,0 +1,62 @@
+import shutil
+
+import tempfile
+
+import unittest
+
+from scrapy.http import Request, Response
+from scrapy.spider import Spider
+from scrapy.utils.test import get_crawler
+
+from visegrad.middlewares import PatternHttpCacheMiddleware
+
+
+class CachedSpider(Spider):
+    name = 'cache-test'
+    HTTPCACHE_POLICIES = (
+        (r'/sittings/', 24 * 60 * 60),
+    )
+
+
+class PatternPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        crawler = get_crawler({
+            'HTTPCACHE_ENABLED': 1,
+            'HTTPCACHE_DIR': self.cache_dir,
+            'HTTPCACHE_POLICY': 'visegrad.middlewares.PatternPolicy',
+        })
+        self.spider = CachedSpider()
+        self.spider.set_crawler(crawler)
+        self.middleware = PatternHttpCacheMiddleware.from_crawler(crawler)
+        self.middleware.spider_opened(self.spider)
+
+    def tearDown(self):
+        self.middleware.spider_closed(self.spider)
+        shutil.rmtree(self.cache_dir)
+
+    def fetch(self, url):
+        request = Request(url)
+        cached = self.middleware.process_request(request, self.spider)
+        if cached is not None:
+            return cached
+        response = Response(url, body='body', request=request)
+        return self.middleware.process_response(
+            request, response, self.spider)
+
+    def test_response_without_headers_is_cached(self):
+        url = 'http://example.com/sittings/1'
+        self.assertNotIn('cached', self.fetch(url).flags)
+        response = self.fetch(url)
+        self.assertIn('cached', response.flags)
+        self.assertEqual(response.body, 'body')
+
+    def test_other_urls_follow_rfc2616(self):
+        url = 'http://example.com/sessions/'
+        self.fetch(url)
+        self.assertNotIn('cached', self.fetch(url).flags)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import json
+
+import unittest
+
+from scrapy.http import Request, TextResponse
+from scrapy.utils.test import get_crawler
+
+from visegrad.items import Motion, Vote, VoteEvent
+from visegrad.spiders.mojepanstwo_pl import MojepanstwoPlSpider
+
+
+def get_vote_event(pk):
+    return {
+        '_id': 'http://api.mojepanstwo.pl/dane/sejm_glosowania/%s' % pk,
+        'id': pk,
+        'data': {
+            'sejm_glosowania.id': pk,
+            'sejm_glosowania.tytul': 'Vote %s' % pk,
+            'sejm_glosowania.czas': '2014-05-06 12:00:00',
+            'sejm_glosowania.wynik_id': '1',
+            'sejm_posiedzenia.id': '',
+            'sejm_glosowania.z': '1',
+            'sejm_glosowania.p': '1',
+            'sejm_glosowania.w': '0',
+            'sejm_glosowania.n': '0',
+        },
+        'layers': {'wynikiIndywidualne': [
+            {'poslowie': {'id': mp, 'nazwa': 'MP %s' % mp},
+             'glosy': {'glos_id': '1'}}
+            for mp in ('1', '2')
+        ]},
+    }
+
+
+class ParseVoteEventsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spider = MojepanstwoPlSpider()
+        self.spider.set_crawler(get_crawler())
+
+    def parse(self, search):
+        url = 'http://api.mojepanstwo.pl/dane/dataset/sejm_glosowania/' \
+            'search.json'
+        request = Request(url, meta={'dataset': 'sejm_glosowania', 'page': 1})
+        response = TextResponse(
+            url, body=json.dumps(search), encoding='utf-8', request=request)
+        return list(self.spider.parse_vote_events(response))
+
+    def test_objects_with_votes_are_parsed_from_search(self):
+        # the pagination follows the objects, as it may in the stream
+        results = self.parse({'search': {
+            'dataobjects': [get_vote_event('1'), get_vote_event('2')],
+            'pagination': {'total': 250},
+        }})
+
+        vote_events = [r for r in results if isinstance(r, VoteEvent)]
+        votes = [r for r in results if isinstance(r, Vote)]
+        pages = [r.meta['page'] for r in results
+                 if isinstance(r, Request) and 'page' in r.meta]
+        self.assertEqual(
+            [v['identifier'] for v in vote_events], ['1', '2'])
+        self.assertEqual(len(votes), 4)
+        self.assertEqual(pages, [2, 3])
+        # no request for the vote event objects themselves
+        self.assertFalse([
+            r for r in results if isinstance(r, Request) and
+            '/dane/sejm_glosowania/' in r.url])
+
+    def test_motion_ids_are_stable(self):
+        search = {'search': {'dataobjects': [get_vote_event('1')]}}
+        runs = []
+        for run in range(2):
+            # a new spider for each run
+            self.setUp()
+            runs.append(self.parse(search))
+
+        motions = [
+            [r for r in results if isinstance(r, Motion)] for results in runs]
+        self.assertEqual(motions[0], motions[1])
+        [vote_event] = [r for r in runs[0] if isinstance(r, VoteEvent)]
+        self.assertEqual(vote_event['motion_id'], motions[0][0]['id'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# -*- coding: utf8 -*-
+import unittest
+
+from scrapy.http import Request, XmlResponse
+from scrapy.utils.test import get_crawler
+
+from visegrad.items import VoteEvent
+from visegrad.spiders.parlament_hu import ParlamentHu
+
+
+VOTES = u'''<?xml version="1.0" encoding="UTF-8"?>
+<szavazasok>
+  <szavazas idopont="2014.05.06.13:07:11">
+    <tulajdonsagok>
+      <tulajdonsag nev="Elfogadás" ertek="Elfogadott"/>
+      <tulajdonsag nev="&quot;Igen&quot;-ek száma" ertek="133"/>
+      <tulajdonsag nev="&quot;Nem&quot;-ek száma" ertek="0"/>
+      <tulajdonsag nev="Tartózkodások" ertek="52"/>
+    </tulajdonsagok>
+  </szavazas>
+</szavazasok>
+'''.encode('utf-8')
+
+
+class ParseVotesTest(unittest.TestCase):
+
+    def test_counts_are_ints_without_zeros(self):
+        url = 'http://www.parlament.hu/cgi-bin/web-api/szavazasok'
+        response = XmlResponse(url, body=VOTES, request=Request(url))
+
+        vote_events = [
+            item for item in ParlamentHu().parse_votes(response)
+            if isinstance(item, VoteEvent)]
+
+        self.assertEqual(len(vote_events), 1)
+        counts = vote_events[0]['counts']
+        self.assertEqual(
+            [(c['option'], c['value']) for c in counts],
+            [('yes', 133), ('abstain', 52)])
+        for count in counts:
+            self.assertIsInstance(count['value'], int)
+
+
+class BackfillShardsTest(unittest.TestCase):
+
+    def get_spider(self, shard):
+        spider = ParlamentHu(shard=shard)
+        spider.set_crawler(get_crawler())
+        return spider
+
+    def test_each_person_is_crawled_by_one_shard(self):
+        spiders = [
+            self.get_spider(shard)
+            for shard in ParlamentHu.get_backfill_shards()]
+        for p_azon in ('k001', 'a123', 's042', 'v777'):
+            crawling = [
+                spider.shard for spider in spiders
+                if spider.get_person_requests(p_azon)]
+            self.assertEqual(len(crawling), 1)
+            self.assertTrue(crawling[0].startswith('people-'))
+
+
+if __name__ == '__main__':
+    unittest.main()
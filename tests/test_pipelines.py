@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import shutil
+
+import tempfile
+
+import unittest
+
+from scrapy import signals
+from scrapy.conf import settings
+from scrapy.contrib.corestats import CoreStats
+from scrapy.spider import Spider
+from scrapy.utils.test import get_crawler
+
+from visegrad.items import Person
+from visegrad.pipelines import ItemMerged, MergePipeline, \
+    StreamingExportPipeline
+
+
+class RecordingPipeline(object):
+    """Keeps the items passed to it."""
+
+    def __init__(self):
+        self.items = []
+
+    def process_item(self, item, spider):
+        self.items.append(item)
+        return item
+
+
+class Stub(object):
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class MergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+        self.old_output = settings.get('OUTPUT_PATH')
+        settings.set('OUTPUT_PATH', self.output)
+
+        crawler = get_crawler()
+        self.core_stats = CoreStats.from_crawler(crawler)
+        self.spider = Spider('test')
+        self.spider.set_crawler(crawler)
+
+        self.pipeline = MergePipeline()
+        self.recorder = RecordingPipeline()
+        crawler.engine = Stub(scraper=Stub(itemproc=Stub(
+            middlewares=[self.pipeline, self.recorder])))
+        self.pipeline.open_spider(self.spider)
+
+    def tearDown(self):
+        self.pipeline.close_spider(self.spider)
+        settings.set('OUTPUT_PATH', self.old_output)
+        shutil.rmtree(self.output)
+
+    def scrape(self, item):
+        """Processes `item` the way Scrapy's scraper does."""
+        try:
+            self.pipeline.process_item(item, self.spider)
+        except ItemMerged, e:
+            self.spider.crawler.signals.send_catch_log(
+                signal=signals.item_dropped, item=item, response=None,
+                spider=self.spider, exception=e)
+
+    def test_merged_item_is_scraped(self):
+        scraped = []
+
+        def item_scraped(item):
+            scraped.append(item)
+        self.spider.crawler.signals.connect(
+            item_scraped, signals.item_scraped, weak=False)
+        identifiers = [{'scheme': 'test', 'identifier': '1'}]
+        self.scrape(Person(identifiers=identifiers, name='Name'))
+        self.scrape(Person(
+            identifiers=identifiers, image='http://example.com/1.jpg'))
+
+        self.pipeline.flush(self.spider)
+        self.assertEqual(scraped, self.recorder.items)
+        [item] = scraped
+        self.assertEqual(item['name'], 'Name')
+        self.assertEqual(item['image'], 'http://example.com/1.jpg')
+
+        stats = self.spider.crawler.stats
+        self.assertEqual(stats.get_value('item_scraped_count'), 1)
+        self.assertEqual(stats.get_value('item_dropped_count'), 0)
+        self.assertEqual(
+            stats.get_value('item_dropped_reasons_count/ItemMerged'), 2)
+
+
+class RecordingExporter(object):
+    """Records exported items instead of sending them to the API."""
+
+    def __init__(self, log):
+        self.exported = []
+
+    def sync_all_reference_data(self):
+        pass
+
+    def get_dependencies(self, source, item):
+        return []
+
+    def export_item(self, source, item):
+        self.exported.append((source, item))
+        return []
+
+    def export_votes_chunk(self, votes):
+        self.exported.extend(('votes', vote) for vote in votes)
+
+
+class StreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+        self.overrides = {'STREAMING_EXPORT': 1, 'OUTPUT_PATH': self.output}
+        self.old_settings = {}
+        for name, value in self.overrides.iteritems():
+            self.old_settings[name] = settings.get(name)
+            settings.set(name, value)
+
+        self.spider = Spider('test')
+        self.spider.exporter_class = RecordingExporter
+        self.spider.set_crawler(get_crawler(self.overrides))
+
+    def tearDown(self):
+        for name, value in self.old_settings.iteritems():
+            settings.set(name, value)
+        shutil.rmtree(self.output)
+
+    def get_person(self, **fields):
+        return Person(
+            identifiers=[{'scheme': 'test', 'identifier': '1'}], **fields)
+
+    def test_export_item(self):
+        pipeline = StreamingExportPipeline()
+        pipeline.open_spider(self.spider)
+        item = self.get_person(name=u'Józef')
+        self.assertIs(pipeline.process_item(item, self.spider), item)
+
+        pipeline.export_batch(pipeline.batch)
+        [(source, exported)] = pipeline.exporter.exported
+        self.assertEqual(source, 'people')
+        self.assertEqual(exported['name'], u'Józef'.encode('utf-8'))
+
+    def test_merge_passes_first_copy(self):
+        pipeline = MergePipeline()
+        pipeline.open_spider(self.spider)
+        try:
+            item = self.get_person(name='Name')
+            self.assertIs(pipeline.process_item(item, self.spider), item)
+            self.assertRaises(
+                ItemMerged, pipeline.process_item,
+                self.get_person(image='http://example.com/1.jpg'),
+                self.spider)
+            [(key, record)] = list(pipeline.store)
+            self.assertEqual(record[2], 2)
+        finally:
+            pipeline.close_spider(self.spider)
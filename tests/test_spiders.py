@@ -0,0 +1,49 @@
+import os
+
+import shutil
+
+import tempfile
+
+import unittest
+
+from scrapy.conf import settings
+from scrapy.contrib.spiderstate import SpiderState
+
+from visegrad.spiders import VisegradSpider
+from visegrad.utils import load_json_file, save_json_file
+
+
+class StateSpider(VisegradSpider):
+    name = 'state-test'
+
+
+class CrawlStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_path = tempfile.mkdtemp()
+        self.old_output_path = settings.get('OUTPUT_PATH')
+        settings.set('OUTPUT_PATH', self.output_path)
+
+    def tearDown(self):
+        settings.set('OUTPUT_PATH', self.old_output_path)
+        shutil.rmtree(self.output_path)
+
+    def test_state_survives_spider_opened(self):
+        filename = os.path.join(
+            self.output_path, StateSpider.name, StateSpider.STATE_FILE)
+        save_json_file(filename, {'sittings': ['1']})
+
+        spider = StateSpider()
+        # Scrapy's SpiderState extension sets spider.state when opened
+        SpiderState().spider_opened(spider)
+        self.assertEqual(spider.crawl_state, {'sittings': ['1']})
+
+        spider.crawl_state['sittings'].append('2')
+        spider.export_finished(spider, 'failed')
+        self.assertEqual(load_json_file(filename), {'sittings': ['1']})
+        spider.export_finished(spider, 'finished')
+        self.assertEqual(load_json_file(filename), {'sittings': ['1', '2']})
+
+
+if __name__ == '__main__':
+    unittest.main()
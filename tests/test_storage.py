@@ -0,0 +1,60 @@
+import os
+
+import shutil
+
+import tempfile
+
+import unittest
+
+from visegrad.storage import SeenStore
+
+
+class SeenStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'seen.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_crawl(self, timestamp, keys, status='finished'):
+        store = SeenStore(self.filename, batch_size=2)
+        try:
+            for key in keys:
+                store.add(key, 'hash-%s' % key, timestamp)
+            if status == 'finished':
+                store.commit()
+            else:
+                store.rollback()
+        finally:
+            store.close()
+
+    def get_hashes(self, keys):
+        store = SeenStore(self.filename)
+        try:
+            return [store.get_hash(key) for key in keys]
+        finally:
+            store.close()
+
+    def test_keys_not_seen_by_two_runs_are_removed(self):
+        self.run_crawl(1, ['a', 'b', 'c'])
+        self.run_crawl(2, ['a', 'b'])
+        self.assertEqual(
+            self.get_hashes(['a', 'b', 'c']), ['hash-a', 'hash-b', 'hash-c'])
+
+        self.run_crawl(3, ['a'])
+        self.assertEqual(
+            self.get_hashes(['a', 'b', 'c']), ['hash-a', 'hash-b', None])
+
+    def test_failed_runs_are_not_recorded(self):
+        self.run_crawl(1, ['a'])
+        self.run_crawl(2, ['b', 'c', 'd'], status='failed')
+        self.run_crawl(3, ['b'], status='failed')
+        self.assertEqual(
+            self.get_hashes(['a', 'b', 'c', 'd']),
+            ['hash-a', None, None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
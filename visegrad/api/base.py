@@ -4,11 +4,11 @@ from scrapy.log import INFO, DEBUG
 
 import vpapi
 
-import json
-
 import os
 
-from visegrad.utils import chunks
+from visegrad.storage import load_items
+from visegrad.utils import chunks, content_hash, load_json_file, \
+    save_json_file, find_output_file
 
 
 class VisegradApiExport(object):
@@ -17,6 +17,7 @@ class VisegradApiExport(object):
     user = 'scraper'
     parliament_code = ''
     single_chamber = True
+    chambers = []
     motions_ids = {}
     events_ids = {}
 
@@ -28,6 +29,10 @@ class VisegradApiExport(object):
     VOTES_FILE = 'Vote.json'
     EVENTS_FILE = 'Event.json'
     SPEECHES_FILE = 'Speech.json'
+    MANIFEST_FILE = 'manifest.json'
+    CHECKPOINT_FILE = 'export-checkpoint.json'
+    REFERENCE_DATA_FILE = 'reference-data.json'
+    RECONCILE_PAGE_SIZE = 1000
     FILES = {
         'people': PEOPLE_FILE,
         'organizations': ORGANIZATIONS_FILE,
@@ -43,13 +48,19 @@ class VisegradApiExport(object):
         vpapi.parliament(self.get_parliament())
         vpapi.authorize(self.get_user(), self.get_password())
 
-        self._chamber = None
         self._ids = {}
+        self._reference_ids = {}
+        self.vote_events_ids = {}
+        self.vote_events_skipped = set()
         if log is None:
             self.log = scrapy.log.msg
         else:
             self.log = log
 
+        self._manifest = load_json_file(
+            self.get_output_filename(self.MANIFEST_FILE))
+        self._checkpoint = self.load_checkpoint()
+
     def get_parliament(self):
         return settings.get('VPAPI_PARLIAMENT_ENDPOINT', self.parliament)
 
@@ -61,6 +72,7 @@ class VisegradApiExport(object):
         return settings.get(var)
 
     def run_export(self):
+        self.sync_all_reference_data()
         self.log('Exporting people', INFO)
         self.export_people()
         self.log('Exporting organizations', INFO)
@@ -76,21 +88,61 @@ class VisegradApiExport(object):
         self.log('Exporting speeches', INFO)
         self.export_speeches()
 
-    def load_json(self, source, exclude=None):
-        if exclude is None:
-            exclude = lambda x: False
-
-        filename = os.path.join(
-            settings.get('OUTPUT_PATH', ''),
-            self.domain,
-            self.FILES[source]
-        )
+        filename = self.get_output_filename(self.CHECKPOINT_FILE)
         if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                for line in f:
-                    item = json.loads(line.rstrip())
-                    if not exclude(item):
-                        yield item
+            os.remove(filename)
+
+    def get_output_filename(self, filename):
+        return os.path.join(
+            settings.get('OUTPUT_PATH', ''), self.domain, filename)
+
+    def load_checkpoint(self):
+        run = self._manifest and self._manifest['run']
+        checkpoint = load_json_file(
+            self.get_output_filename(self.CHECKPOINT_FILE))
+        if not settings.get('EXPORT_RESUME') or not checkpoint or \
+                checkpoint['run'] != run:
+            checkpoint = {'run': run, 'done': {}}
+        return checkpoint
+
+    def get_shards(self, source):
+        """Returns paths of the files the data of `source` is split to."""
+        if self._manifest is None:
+            filename = find_output_file(
+                self.get_output_filename(self.FILES[source]))
+            return [filename] if filename else []
+
+        name = os.path.splitext(self.FILES[source])[0]
+        return [
+            self.get_output_filename(shard['file'])
+            for shard in self._manifest['files'].get(name, [])
+        ]
+
+    def load_shard(self, filename, exclude=None):
+        for item in load_items(filename):
+            if exclude is None or not exclude(item):
+                yield item
+
+    def load_json(self, source, exclude=None, checkpoint=None):
+        """Yields scraped items of `source`. When `checkpoint` is given,
+        shards read to the end are recorded under that name and they are
+        skipped when a failed export is resumed.
+        """
+        done = []
+        if checkpoint:
+            done = self._checkpoint['done'].setdefault(checkpoint, [])
+
+        for filename in self.get_shards(source):
+            shard = os.path.basename(filename)
+            if shard in done:
+                continue
+            for item in self.load_shard(filename, exclude):
+                yield item
+            if checkpoint:
+                done.append(shard)
+                save_json_file(
+                    self.get_output_filename(self.CHECKPOINT_FILE),
+                    self._checkpoint)
 
     def get_or_create(self, endpoint, item, refresh=False, where_keys=None):
         sort = []
@@ -151,6 +203,37 @@ class VisegradApiExport(object):
         self.log('Created %d items' % len(resp['_items']), DEBUG)
         return
 
+    def reconcile(self, endpoint, items, where, key):
+        """Makes the remote items matching `where` equal to `items`.
+        Existing items are fetched at once and paired with `items` by `key`.
+        New items are created in one batch, changed ones are updated and
+        the ones which are not in `items` anymore are deleted. Existing
+        items without `key` cannot be paired and are left untouched.
+        """
+        existing = {}
+        for resp in vpapi.getall(endpoint, where=where,
+                                 max_results=self.RECONCILE_PAGE_SIZE):
+            if resp.get(key) is not None:
+                existing[resp[key]] = resp
+
+        created = []
+        for item in items:
+            resp = existing.pop(item.get(key), None)
+            if resp is None:
+                created.append(item)
+            elif any(resp.get(k) != v for k, v in item.iteritems()):
+                resp = vpapi.put('%s/%s' % (endpoint, resp['id']), item)
+                if resp['_status'] != 'OK':
+                    raise Exception(resp)
+                self.log('Updated %s' % resp['_links']['self']['href'], DEBUG)
+
+        if created:
+            self.batch_create(endpoint, created)
+
+        for resp in existing.itervalues():
+            vpapi.delete('%s/%s' % (endpoint, resp['id']))
+            self.log('Deleted %s/%s' % (endpoint, resp['id']), DEBUG)
+
     def get_remote_id(self, scheme, identifier):
         key = "%s/%s" % (scheme, identifier)
         if key in self._ids:
@@ -173,132 +256,300 @@ class VisegradApiExport(object):
             self._ids[key] = item['id']
             return item['id']
 
-    def make_chamber(self, index):
-        raise NotImplementedError()
+    def get_event_id(self, identifier):
+        """Returns remote id of the event exported in this run or found by
+        its identifier, if it was left out of the scraped data.
+        """
+        if identifier not in self.events_ids:
+            resp = vpapi.getfirst('events', where={'identifier': identifier})
+            if not resp:
+                raise KeyError(identifier)
+            self.events_ids[identifier] = resp['id']
+        return self.events_ids[identifier]
+
+    def get_reference_data(self):
+        """Static items every export relies on, keyed by registry name.
+        Each value is an (endpoint, items) pair.
+        """
+        return {
+            'chambers': ('organizations', self.chambers),
+        }
+
+    def sync_reference_data(self, name):
+        """Upserts items of the reference data registry `name` only when
+        their content changed since the last sync and returns their remote
+        ids. Ids of unchanged items are read from the local state file.
+        """
+        if name in self._reference_ids:
+            return self._reference_ids[name]
+
+        endpoint, items = self.get_reference_data()[name]
+        filename = self.get_output_filename(self.REFERENCE_DATA_FILE)
+        state = load_json_file(filename, {})
+        digest = content_hash(
+            [vpapi.SERVER_NAME, self.get_parliament(), endpoint, items])
+
+        synced = state.get(name)
+        if settings.get('FORCE_REFERENCE_DATA_SYNC') or not synced or \
+                synced['hash'] != digest:
+            self.log('Syncing %s' % name, INFO)
+            ids = [self.get_or_create(endpoint, item)['id'] for item in items]
+            state[name] = {'hash': digest, 'ids': ids}
+            save_json_file(filename, state)
+
+        ids = state[name]['ids']
+        for item, pk in zip(items, ids):
+            self.add_remote_ids(item, pk)
+        self._reference_ids[name] = ids
+        return ids
+
+    def sync_all_reference_data(self):
+        """Syncs all the reference data registries, so items referring to
+        reference items by identifiers are resolved from the start.
+        """
+        for name in sorted(self.get_reference_data()):
+            self.sync_reference_data(name)
 
     def get_chamber(self, index=0):
-        if not self._chamber:
-            self._chamber = self.make_chamber(index)
-        return self._chamber
+        ids = self.sync_reference_data('chambers')
+        return dict(self.chambers[index], id=ids[index])
+
+    def add_remote_ids(self, item, pk):
+        for identifier in item.get('identifiers', []):
+            if 'scheme' in identifier:
+                self._ids['%(scheme)s/%(identifier)s' % identifier] = pk
+
+    def get_dependencies(self, source, item):
+        """Returns keys of the items `item` of `source` refers to, in the
+        form of keys returned by `export_item`.
+        """
+        refs = []
+        events = []
+        if source == 'organizations' and 'parent_id' in item:
+            refs.append(item['parent_id'])
+        elif source == 'memberships':
+            refs.extend([item['person_id'], item['organization_id']])
+        elif source == 'events' and 'parent_id' in item:
+            events.append(item['parent_id'])
+        elif source in ('motions', 'vote-events'):
+            events.append(item.get('legislative_session_id'))
+        elif source == 'votes':
+            refs.append(item.get('voter_id'))
+        elif source == 'speeches':
+            refs.append(item.get('creator_id'))
+            events.append(item.get('event_id'))
+
+        keys = [
+            ('ids', ref['scheme'], ref['identifier'])
+            for ref in refs if isinstance(ref, dict)
+        ]
+        keys.extend(('events', pk) for pk in events if pk)
+        if source == 'vote-events' and 'motion_id' in item:
+            keys.append(('motions', item['motion_id']))
+        if source == 'votes':
+            keys.append(('vote-events', item['vote_event_id']))
+        return keys
+
+    def is_exported(self, key, lookup=True):
+        """Tells if the item with `key` was exported in this run. Items
+        referred to by identifiers and events are looked up in the API too,
+        unless `lookup` is False.
+        """
+        kind, value = key[0], key[1:]
+        if kind == 'ids':
+            if '%s/%s' % value in self._ids:
+                return True
+            return lookup and self.get_remote_id(*value) is not None
+        if kind == 'events':
+            if value[0] in self.events_ids:
+                return True
+            if not lookup:
+                return False
+            try:
+                self.get_event_id(value[0])
+            except KeyError:
+                return False
+            return True
+        if kind == 'motions':
+            return value[0] in self.motions_ids
+        if kind == 'vote-events':
+            return value[0] in self.vote_events_ids or \
+                value[0] in self.vote_events_skipped
+
+    def export_item(self, source, item):
+        """Exports one scraped item of `source` and returns keys other items
+        may refer to it by. Votes are exported by `export_votes_chunk`.
+        """
+        if source == 'people':
+            self.export_person(item)
+        elif source == 'organizations':
+            self.export_organization(item)
+        elif source == 'memberships':
+            self.export_membership(item)
+        elif source == 'events':
+            self.export_event(item)
+            return [('events', item['identifier'])]
+        elif source == 'motions':
+            motion_id = self.export_motion(item)
+            if motion_id:
+                return [('motions', motion_id)]
+        elif source == 'vote-events':
+            return [('vote-events', self.export_vote_event(item))]
+        elif source == 'speeches':
+            self.export_speech(item)
+        else:
+            raise ValueError('Unknown source %s' % source)
+
+        return [
+            ('ids', i['scheme'], i['identifier'])
+            for i in item.get('identifiers', []) if 'scheme' in i
+        ]
+
+    def export_person(self, person):
+        resp = self.get_or_create('people', person)
+        self.add_remote_ids(person, resp['id'])
+        if self.single_chamber:
+            membership = {
+                'person_id': resp['id'],
+                'organization_id': self.get_chamber()['id']
+            }
+            self.get_or_create('memberships', membership)
 
     def export_people(self):
-        chamber = self.get_chamber()
-        people = self.load_json('people')
+        people = self.load_json('people', checkpoint='people')
 
         for person in people:
-            resp = self.get_or_create('people', person)
-            if self.single_chamber:
-                membership = {
-                    'person_id': resp['id'],
-                    'organization_id': chamber['id']
-                }
-                self.get_or_create('memberships', membership)
+            self.export_person(person)
+
+    def export_organization(self, organization):
+        if self.single_chamber and 'parent_id' not in organization:
+            organization['parent_id'] = self.get_chamber()['id']
+        elif 'parent_id' in organization:
+            organization['parent_id'] = self.get_remote_id(
+                scheme=organization['parent_id']['scheme'],
+                identifier=organization['parent_id']['identifier']
+            )
+        resp = self.get_or_create('organizations', organization)
+        self.add_remote_ids(organization, resp['id'])
 
     def export_organizations(self):
-        chamber = self.get_chamber()
-        organizations = self.load_json('organizations')
+        organizations = self.load_json(
+            'organizations', checkpoint='organizations')
 
         for organization in organizations:
-            if self.single_chamber and 'parent_id' not in organization:
-                organization['parent_id'] = chamber['id']
-            elif 'parent_id' in organization:
-                organization['parent_id'] = self.get_remote_id(
-                    scheme=organization['parent_id']['scheme'],
-                    identifier=organization['parent_id']['identifier']
-                )
-            self.get_or_create('organizations', organization)
+            self.export_organization(organization)
+
+    def export_membership(self, item):
+        person_id = self.get_remote_id(
+            scheme=item['person_id']['scheme'],
+            identifier=item['person_id']['identifier'])
+        organization_id = self.get_remote_id(
+            scheme=item['organization_id']['scheme'],
+            identifier=item['organization_id']['identifier'])
+        if person_id and organization_id:
+            item['person_id'] = person_id
+            item['organization_id'] = organization_id
+            self.get_or_create('memberships', item)
 
     def export_memberships(self):
-        memberships = self.load_json('memberships')
+        memberships = self.load_json('memberships', checkpoint='memberships')
 
         for item in memberships:
-            person_id = self.get_remote_id(
-                scheme=item['person_id']['scheme'],
-                identifier=item['person_id']['identifier'])
-            organization_id = self.get_remote_id(
-                scheme=item['organization_id']['scheme'],
-                identifier=item['organization_id']['identifier'])
-            if person_id and organization_id:
-                item['person_id'] = person_id
-                item['organization_id'] = organization_id
-                self.get_or_create('memberships', item)
+            self.export_membership(item)
+
+    def export_event(self, item):
+        item['organization_id'] = self.get_chamber()['id']
+        if 'parent_id' in item:
+            item['parent_id'] = self.get_event_id(item['parent_id'])
+        resp = self.get_or_create('events', item)
+        self.events_ids[item['identifier']] = resp['id']
 
     def export_events(self):
-        chamber = self.get_chamber()
         parent_events = self.load_json(
-            'events', exclude=lambda x: 'parent_id' in x)
+            'events', exclude=lambda x: 'parent_id' in x,
+            checkpoint='parent-events')
         child_events = self.load_json(
-            'events', exclude=lambda x: 'parent_id' not in x)
+            'events', exclude=lambda x: 'parent_id' not in x,
+            checkpoint='child-events')
 
         for item in parent_events:
-            item['organization_id'] = chamber['id']
-            resp = self.get_or_create('events', item)
-            self.events_ids[item['identifier']] = resp['id']
+            self.export_event(item)
 
         for item in child_events:
-            item['organization_id'] = chamber['id']
-            item['parent_id'] = self.events_ids[item['parent_id']]
-            resp = self.get_or_create('events', item)
-            self.events_ids[item['identifier']] = resp['id']
+            self.export_event(item)
+
+    def export_motion(self, item):
+        item['organization_id'] = self.get_chamber()['id']
+        motion_id = item.pop('id', None)
+        session_id = item.get('legislative_session_id')
+        if session_id:
+            item['legislative_session_id'] = self.get_event_id(session_id)
+        resp = self.get_or_create('motions', item)
+
+        if motion_id:
+            self.motions_ids[motion_id] = resp['id']
+        return motion_id
 
     def export_motions(self):
-        chamber = self.get_chamber()
         motions = self.load_json('motions')
-        motion_id = None
 
         for item in motions:
-            item['organization_id'] = chamber['id']
-            if 'id' in item:
-                motion_id = item['id']
-                del item['id']
-            session_id = item.get('legislative_session_id')
-            if session_id:
-                item['legislative_session_id'] = self.events_ids[session_id]
-            resp = self.get_or_create('motions', item)
+            self.export_motion(item)
 
-            if motion_id:
-                self.motions_ids[motion_id] = resp['id']
+    def export_vote_event(self, vote_event):
+        local_identifier = vote_event['identifier']
+        del vote_event['identifier']
+
+        if 'motion_id' in vote_event:
+            vote_event['motion_id'] = self.motions_ids[vote_event['motion_id']]
+
+        session_id = vote_event.get('legislative_session_id')
+        if session_id:
+            vote_event['legislative_session_id'] = self.get_event_id(session_id)
+
+        vote_event_resp = self.get_or_create(
+            'vote-events', vote_event, refresh=True)
+        # send votes only once, when vote event is created
+        if not vote_event_resp.get('votes'):
+            self.vote_events_ids[local_identifier] = vote_event_resp['id']
+        else:
+            self.vote_events_skipped.add(local_identifier)
+        return local_identifier
+
+    def export_votes_chunk(self, votes):
+        votes = [v for v in votes if v['vote_event_id'] in self.vote_events_ids]
+        if not votes:
+            return
+        for v in votes:
+            v['vote_event_id'] = self.vote_events_ids[v['vote_event_id']]
+            v['voter_id'] = self.get_remote_id(
+                    scheme=v['voter_id']['scheme'],
+                    identifier=v['voter_id']['identifier'])
+        self.batch_create('votes', votes)
 
     def export_votes(self):
         vote_events = self.load_json('vote-events')
         votes = self.load_json('votes')
-        vote_events_ids = {}
 
         for vote_event in vote_events:
-            local_identifier = vote_event['identifier']
-            del vote_event['identifier']
-
-            if 'motion_id' in vote_event:
-                vote_event['motion_id'] = self.motions_ids[vote_event['motion_id']]
-
-            session_id = vote_event.get('legislative_session_id')
-            if session_id:
-                vote_event['legislative_session_id'] = self.events_ids[session_id]
-
-            vote_event_resp = self.get_or_create(
-                'vote-events', vote_event, refresh=True)
-            # send votes only once, when vote event is created
-            if not vote_event_resp.get('votes'):
-                vote_events_ids[local_identifier] = vote_event_resp['id']
+            self.export_vote_event(vote_event)
 
-        filter_func = lambda x: x['vote_event_id'] in vote_events_ids
+        filter_func = lambda x: x['vote_event_id'] in self.vote_events_ids
         for votes_chunk in chunks(votes, 400, filter_func):
-            for v in votes_chunk:
-                v['vote_event_id'] = vote_events_ids[v['vote_event_id']]
-                v['voter_id'] = self.get_remote_id(
-                        scheme=v['voter_id']['scheme'],
-                        identifier=v['voter_id']['identifier'])
-            self.batch_create('votes', votes_chunk)
+            self.export_votes_chunk(votes_chunk)
+
+    def export_speech(self, speech):
+        if 'creator_id' in speech:
+            speech['creator_id'] = self.get_remote_id(
+                scheme=speech['creator_id']['scheme'],
+                identifier=speech['creator_id']['identifier'])
+        session_id = speech.get('event_id')
+        if session_id:
+            speech['event_id'] = self.get_event_id(session_id)
+        self.get_or_create('speeches', speech)
 
     def export_speeches(self):
-        speeches = self.load_json('speeches')
+        speeches = self.load_json('speeches', checkpoint='speeches')
 
         for speech in speeches:
-            if 'creator_id' in speech:
-                speech['creator_id'] = self.get_remote_id(
-                    scheme=speech['creator_id']['scheme'],
-                    identifier=speech['creator_id']['identifier'])
-            session_id = speech.get('event_id')
-            if session_id:
-                speech['event_id'] = self.events_ids[session_id]
-            self.get_or_create('speeches', speech)
+            self.export_speech(speech)
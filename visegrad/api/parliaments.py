@@ -17,83 +17,94 @@ class SkustinaMeApiExport(VisegradApiExport):
     parliament = 'me/skupstina'
     parliament_code = 'ME_SKUPSTINA'
     domain = 'skupstina.me'
-
-    def make_chamber(self, index):
-        chamber = {
+    chambers = [
+        {
             'classification': 'chamber',
             'identifiers': [
                 {'identifier': '25', 'scheme': 'skupstina.me/chamber'}
             ],
             'name': u'Skupština Crne Gore 2012 - 2015',
-        }
-
-        return self.get_or_create('organizations', chamber)
-
-    def export_speeches(self):
-        speeches = self.load_json('speeches')
-        people = {}
+        },
+    ]
+
+    def __init__(self, *args, **kwargs):
+        super(SkustinaMeApiExport, self).__init__(*args, **kwargs)
+        self._people = None
+
+    def get_people_by_name(self):
+        if self._people is None:
+            self._people = {}
+            for p in vpapi.getall('people'):
+                name = self.normalize_name(p['name'])
+                self._people[name] = p['id']
+        return self._people
+
+    def export_speech(self, speech):
+        people = self.get_people_by_name()
         prefix_regex = re.compile(
             ur'(pred\u015bedavaju\u0107i )|(pred\u015bednik )|\
 (generalni sekretar )', re.U)
 
-        for p in vpapi.getall('people'):
-            name = self.normalize_name(p['name'])
-            people[name] = p['id']
-
-        for speech in speeches:
-            session_id = speech.get('event_id')
-            speech['event_id'] = self.events_ids[session_id]
-            url = speech['sources'][0]['url']
-            if url.endswith('.pdf'):
-                parsed_speeches = self.download_pdf(url)
-                for n, s in enumerate(parsed_speeches):
-                    text_speech = speech.copy()
-                    text_speech['text'] = s['text']
-                    text_speech['position'] = n + 1
-                    text_speech['type'] = 'speech'
-
-                    creator = self.normalize_name(s['creator'])
-                    creator = prefix_regex.sub('', creator)
-
-                    if creator in people:
-                        text_speech['creator_id'] = people[creator]
-                    else:
-                        creator_id = None
-
-                        for name in people:
-                            if name in creator:
-                                creator_id = people[name]
-                                break
-
-                        if creator_id is None:
-                            resp = vpapi.getfirst(
-                                'people', where={
-                                    'name': {
-                                        '$regex': s['creator'],
-                                        'options': 'i'
-                                    }
+        session_id = speech.get('event_id')
+        speech['event_id'] = self.get_event_id(session_id)
+        url = speech['sources'][0]['url']
+        if url.endswith('.pdf'):
+            parsed_speeches = self.download_pdf(url)
+            text_speeches = []
+            for n, s in enumerate(parsed_speeches):
+                text_speech = speech.copy()
+                text_speech['text'] = s['text']
+                text_speech['position'] = n + 1
+                text_speech['type'] = 'speech'
+
+                creator = self.normalize_name(s['creator'])
+                creator = prefix_regex.sub('', creator)
+
+                if creator in people:
+                    text_speech['creator_id'] = people[creator]
+                else:
+                    creator_id = None
+
+                    for name in people:
+                        if name in creator:
+                            creator_id = people[name]
+                            break
+
+                    if creator_id is None:
+                        resp = vpapi.getfirst(
+                            'people', where={
+                                'name': {
+                                    '$regex': s['creator'],
+                                    'options': 'i'
                                 }
-                            )
-                            if resp is None:
-                                self.log('Person "%(creator)s" not found. \
+                            }
+                        )
+                        if resp is None:
+                            self.log('Person "%(creator)s" not found. \
 Creating one' % s, WARNING)
-                                item = {
-                                    'name': s['creator'],
-                                    'sources': text_speech['sources']
-                                }
-                                resp = vpapi.post('people', item)
-                            creator_id = resp['id']
-
-                        people[creator] = creator_id
-                        text_speech['creator_id'] = creator_id
-
-                    self.get_or_create(
-                        'speeches',
-                        text_speech,
-                        where_keys=['event_id', 'position']
-                    )
-            else:
-                self.get_or_create('speeches', speech)
+                            item = {
+                                'name': s['creator'],
+                                'sources': text_speech['sources']
+                            }
+                            resp = vpapi.post('people', item)
+                        creator_id = resp['id']
+
+                    people[creator] = creator_id
+                    text_speech['creator_id'] = creator_id
+
+                text_speeches.append(text_speech)
+
+            if not text_speeches:
+                self.log('No speeches found in %s' % url, WARNING)
+                return
+            self.reconcile(
+                'speeches',
+                text_speeches,
+                where={'event_id': speech['event_id']},
+                key='position'
+            )
+        else:
+            self.get_or_create('speeches', speech)
 
     def normalize_name(self, value):
         titles_regex = re.compile(
@@ -124,73 +135,69 @@ class ParlamentHuApiExport(VisegradApiExport):
     parliament_code = 'HU_ORSZAGGYULES'
     domain = 'parlament.hu'
     single_chamber = False
-
-    def make_chamber(self, index):
-        chambers = [
-            {
-                'identifiers': [
-                    {'identifier': '40', 'scheme': 'parlament.hu/chamber'}
-                ],
-                'name': u'Országgyűlés 2014 - ',
-            },
-            {
-                'identifiers': [
-                    {'identifier': '39', 'scheme': 'parlament.hu/chamber'}
-                ],
-                'name': u'Országgyűlés 2010 - 2014',
-            },
-            {
-                'identifiers': [
-                    {'identifier': '38', 'scheme': 'parlament.hu/chamber'}
-                ],
-                'name': u'Országgyűlés 2006 - 2010',
-            },
-            {
-                'identifiers': [
-                    {'identifier': '37', 'scheme': 'parlament.hu/chamber'}
-                ],
-                'name': u'Országgyűlés 2002 - 2006',
-            },
-            {
-                'identifiers': [
-                    {'identifier': '36', 'scheme': 'parlament.hu/chamber'}
-                ],
-                'name': u'Országgyűlés 1998 - 2002',
-            },
-            {
-                'identifiers': [
-                    {'identifier': '35', 'scheme': 'parlament.hu/chamber'}
-                ],
-                'name': u'Országgyűlés 1994 - 98',
-            },
-            {
-                'identifiers': [
-                    {'identifier': '34', 'scheme': 'parlament.hu/chamber'}
-                ],
-                'name': u'Országgyűlés 1990 - 94',
-            }
-        ]
-
-        results = []
-
-        for ch in chambers:
-            ch['classification'] = 'chamber'
-            results.append(self.get_or_create('organizations', ch))
-        return results[index]
+    chambers = [
+        {
+            'classification': 'chamber',
+            'identifiers': [
+                {'identifier': '40', 'scheme': 'parlament.hu/chamber'}
+            ],
+            'name': u'Országgyűlés 2014 - ',
+        },
+        {
+            'classification': 'chamber',
+            'identifiers': [
+                {'identifier': '39', 'scheme': 'parlament.hu/chamber'}
+            ],
+            'name': u'Országgyűlés 2010 - 2014',
+        },
+        {
+            'classification': 'chamber',
+            'identifiers': [
+                {'identifier': '38', 'scheme': 'parlament.hu/chamber'}
+            ],
+            'name': u'Országgyűlés 2006 - 2010',
+        },
+        {
+            'classification': 'chamber',
+            'identifiers': [
+                {'identifier': '37', 'scheme': 'parlament.hu/chamber'}
+            ],
+            'name': u'Országgyűlés 2002 - 2006',
+        },
+        {
+            'classification': 'chamber',
+            'identifiers': [
+                {'identifier': '36', 'scheme': 'parlament.hu/chamber'}
+            ],
+            'name': u'Országgyűlés 1998 - 2002',
+        },
+        {
+            'classification': 'chamber',
+            'identifiers': [
+                {'identifier': '35', 'scheme': 'parlament.hu/chamber'}
+            ],
+            'name': u'Országgyűlés 1994 - 98',
+        },
+        {
+            'classification': 'chamber',
+            'identifiers': [
+                {'identifier': '34', 'scheme': 'parlament.hu/chamber'}
+            ],
+            'name': u'Országgyűlés 1990 - 94',
+        },
+    ]
 
 
 class SejmPlApiExport(VisegradApiExport):
     parliament = 'pl/sejm'
     parliament_code = 'PL_SEJM'
     domain = 'mojepanstwo.pl'
-
-    def make_chamber(self, index):
-        chamber = {
+    chambers = [
+        {
             'classification': 'chamber',
             'identifiers': [
                 {'identifier': '7', 'scheme': 'mojepanstwo.pl/chamber'}
             ],
             'name': u'Sejm 2011 - ',
-        }
-
-        return self.get_or_create('organizations', chamber)
+        },
+    ]
@@ -0,0 +1,203 @@
+import json
+
+import multiprocessing
+
+import os
+
+import shutil
+
+import subprocess
+
+import sys
+
+import time
+
+from datetime import datetime
+
+from scrapy.command import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from visegrad.pipelines import ExportPipeline, get_item_key, merge_items
+from visegrad.storage import fingerprint, FingerprintSet, MergeStore, \
+    load_items
+from visegrad.utils import get_compression_extension, load_json_file, \
+    open_output, save_json_file
+
+
+def merge_outputs(directories, directory, compression=None,
+                  memory_limit=100000):
+    """Merges the scraped data in shard `directories` into `directory`.
+    Items with the same key are merged into one, other items are written
+    once. Each item class is written to one file listed in the manifest
+    of `directory`.
+    """
+    files = {}
+    for d in directories:
+        manifest = load_json_file(
+            os.path.join(d, ExportPipeline.MANIFEST_FILE))
+        for name, shards in manifest['files'].iteritems():
+            files.setdefault(name, []).extend(
+                os.path.join(d, shard['file']) for shard in shards)
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    manifest = {
+        'run': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+        'status': 'finished',
+        'files': {},
+    }
+    for name, filenames in sorted(files.iteritems()):
+        store = MergeStore(
+            os.path.join(directory, 'merge.sqlite'), memory_limit)
+        seen = FingerprintSet()
+        filename = name + '.json' + get_compression_extension(compression)
+        count = 0
+
+        f = open_output(os.path.join(directory, filename), compression)
+        try:
+            for shard in filenames:
+                for item in load_items(shard):
+                    k = get_item_key(item)
+                    if k is not None:
+                        store.merge(k, item, merge_items)
+                        continue
+                    fp = fingerprint(json.dumps(item, sort_keys=True))
+                    if seen.add(fp):
+                        f.write(json.dumps(item) + '\n')
+                        count += 1
+            for k, item in store:
+                f.write(json.dumps(item) + '\n')
+                count += 1
+        finally:
+            f.close()
+            store.close()
+            seen.close()
+
+        manifest['files'][name] = [{
+            'file': filename,
+            'items': count,
+            'first_key': None,
+            'last_key': None,
+        }]
+    save_json_file(
+        os.path.join(directory, ExportPipeline.MANIFEST_FILE), manifest)
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return '[options] <spider>'
+
+    def short_desc(self):
+        return 'Crawl the history of a parliament in parallel shards'
+
+    def long_desc(self):
+        return 'Crawl the shards of the history of a parliament, each in ' \
+            'a separate process with its own output directory, job ' \
+            'directory and HTTP cache, and merge their data to the output ' \
+            'of the spider. Finished shards are skipped when the backfill ' \
+            'is run again, other shards are crawled again from scratch ' \
+            'using their HTTP cache. Export the merged data with ' \
+            '"scrapy export <spider>".'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option('-j', '--jobs', type='int',
+            default=multiprocessing.cpu_count(),
+            help='number of shards crawled at once')
+        parser.add_option('--shard', action='append', default=[],
+            help='crawl only this shard (can be repeated)')
+        parser.add_option('--restart', action='store_true',
+            help='crawl finished shards again')
+
+    def get_shard_path(self, name, shard):
+        return os.path.join(
+            self.settings.get('OUTPUT_PATH', ''), name, 'backfill', shard)
+
+    def get_status(self, name, shard):
+        manifest = load_json_file(os.path.join(
+            self.get_shard_path(name, shard), name,
+            ExportPipeline.MANIFEST_FILE))
+        return manifest and manifest.get('status')
+
+    def start_shard(self, name, shard):
+        path = self.get_shard_path(name, shard)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # the requests seen by a previous crawl would be skipped while its
+        # output is replaced, so the shard is crawled from scratch, only the
+        # HTTP cache is kept
+        for d in ('job', name):
+            shutil.rmtree(os.path.join(path, d), True)
+        return subprocess.Popen([
+            sys.executable, '-m', 'scrapy.cmdline', 'crawl', name,
+            '-a', 'shard=%s' % shard,
+            '-s', 'OUTPUT_PATH=%s' % path,
+            '-s', 'JOBDIR=%s' % os.path.join(path, 'job'),
+            '-s', 'LOG_FILE=%s' % os.path.join(path, 'crawl.log'),
+            # shards crawled at once must not write to the same cache
+            '-s', 'HTTPCACHE_DIR=%s' % os.path.abspath(
+                os.path.join(path, 'httpcache')),
+            '-s', 'CRAWL_LATEST_ONLY=0',
+            '-s', 'EXPORT_ENABLED=0',
+            '-s', 'STREAMING_EXPORT=0',
+        ])
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        name = args[0]
+
+        crawler = self.crawler_process.create_crawler()
+        spider = crawler.spiders.create(name)
+        shards = spider.get_backfill_shards()
+        if not shards:
+            raise UsageError('Spider %s does not support backfills' % name)
+        for shard in opts.shard:
+            if shard not in shards:
+                raise UsageError('Unknown shard %s, shards of %s: %s' % (
+                    shard, name, ', '.join(shards)))
+
+        pending = []
+        for shard in opts.shard or shards:
+            if self.get_status(name, shard) == 'finished':
+                if not opts.restart:
+                    print '%s: finished' % shard
+                    continue
+            pending.append(shard)
+
+        running = {}
+        failed = []
+        while pending or running:
+            while pending and len(running) < opts.jobs:
+                shard = pending.pop(0)
+                print '%s: started' % shard
+                running[shard] = self.start_shard(name, shard)
+            time.sleep(1)
+            for shard, process in running.items():
+                if process.poll() is None:
+                    continue
+                del running[shard]
+                status = self.get_status(name, shard) or 'failed'
+                print '%s: %s' % (shard, status)
+                if status != 'finished':
+                    failed.append(shard)
+
+        if failed:
+            print 'Not merging, failed shards: %s' % ', '.join(failed)
+            self.exitcode = 1
+            return
+        unfinished = [
+            s for s in shards if self.get_status(name, s) != 'finished']
+        if unfinished:
+            print 'Not merging, unfinished shards: %s' % ', '.join(unfinished)
+            return
+
+        print 'Merging shards'
+        merge_outputs(
+            [os.path.join(self.get_shard_path(name, shard), name)
+             for shard in shards],
+            os.path.join(self.settings.get('OUTPUT_PATH', ''), name),
+            compression=self.settings.get('OUTPUT_COMPRESSION'),
+            memory_limit=self.settings.getint('MERGE_MEMORY_LIMIT', 100000))
@@ -0,0 +1,58 @@
+import json
+
+import time
+
+from scrapy.command import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.http import Request
+from scrapy.item import BaseItem
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.misc import arg_to_iter
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {'LOG_ENABLED': False}
+
+    def syntax(self):
+        return '[options] <spider> <callback> <file>'
+
+    def short_desc(self):
+        return 'Measure parse time of a spider callback on a recorded page'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option('-n', '--number', type='int', default=100,
+            help='number of times to parse the page')
+        parser.add_option('-u', '--url', default='http://localhost/',
+            help='url of the recorded page')
+        parser.add_option('-m', '--meta', default='{}',
+            help='request meta the callback expects, as JSON')
+
+    def run(self, args, opts):
+        if len(args) != 3:
+            raise UsageError()
+        name, callback_name, filename = args
+
+        crawler = self.crawler_process.create_crawler()
+        crawler.configure()
+        spider = crawler.spiders.create(name)
+        spider.set_crawler(crawler)
+        callback = getattr(spider, callback_name)
+
+        with open(filename, 'rb') as f:
+            body = f.read()
+        request = Request(opts.url, meta=json.loads(opts.meta))
+        respcls = responsetypes.from_args(
+            filename=filename, url=opts.url, body=body)
+        response = respcls(url=opts.url, body=body, request=request)
+
+        start = time.time()
+        for i in xrange(opts.number):
+            results = list(arg_to_iter(callback(response)))
+        elapsed = time.time() - start
+
+        items = len([r for r in results if isinstance(r, BaseItem)])
+        print '%s.%s: %.3f ms per page, %d items, %d requests' % (
+            spider.name, callback_name, elapsed * 1000 / opts.number,
+            items, len(results) - items)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import json
+
+import time
+
+from cStringIO import StringIO
+
+from scrapy.command import ScrapyCommand
+from scrapy.contrib.exporter import JsonLinesItemExporter
+
+from visegrad.items import Person, SkupstinaMePerson, VoteEvent, Count, \
+    Vote, Speech
+from visegrad.serializers import JsonLinesSerializer
+
+
+def sample_items():
+    return [
+        Person(
+            name=u'Kov\xe1cs J\xe1nos',
+            given_name=u'J\xe1nos',
+            family_name=u'Kov\xe1cs',
+            identifiers=[
+                {'identifier': 'k123', 'scheme': 'parlament.hu/people'}],
+            sources=[{'url': 'http://www.parlament.hu/'}],
+        ),
+        SkupstinaMePerson(
+            name=u'Petar Petrović',
+            identifiers='123',
+            sources=[{'url': 'http://www.skupstina.me/'}],
+        ),
+        VoteEvent(
+            identifier='2015.03.10.12:00:00',
+            start_date='2015-03-10T11:00:00',
+            result='pass',
+            counts=[
+                Count(option='yes', value='120'),
+                Count(option='no', value='60'),
+            ],
+            sources=[{'url': 'http://www.parlament.hu/'}],
+        ),
+        Vote(
+            vote_event_id='2015.03.10.12:00:00',
+            voter_id={'identifier': 'k123', 'scheme': 'parlament.hu/people'},
+            option='yes',
+        ),
+        Speech(
+            text=u'Tisztelt Orsz\xe1ggyűl\xe9s! ' * 50,
+            date='2015-03-10T11:00:00',
+            position=3,
+            event_id='40_123_0',
+            creator_id={'identifier': 'k123', 'scheme': 'parlament.hu/people'},
+            sources=[{'url': 'http://www.parlament.hu/'}],
+        ),
+    ]
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {'LOG_ENABLED': False}
+
+    def syntax(self):
+        return '[options]'
+
+    def short_desc(self):
+        return 'Compare JsonLinesItemExporter with JsonLinesSerializer'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option('-n', '--number', type='int', default=100000,
+            help='number of items of each class to serialize')
+
+    def run(self, args, opts):
+        print '%-20s %12s %12s %8s' % (
+            'item', 'exporter', 'serializer', 'speedup')
+        for item in sample_items():
+            f = StringIO()
+            exporter = JsonLinesItemExporter(f)
+            start = time.time()
+            for i in xrange(opts.number):
+                exporter.export_item(item)
+            exporter_time = time.time() - start
+            expected = f.getvalue().splitlines()[0]
+
+            serializer = JsonLinesSerializer.for_class(item.__class__)
+            f = StringIO()
+            start = time.time()
+            for i in xrange(opts.number):
+                f.write(serializer(item))
+            serializer_time = time.time() - start
+            line = f.getvalue().splitlines()[0]
+
+            if json.loads(line) != json.loads(expected):
+                raise ValueError('%s serialized differently: %s != %s' % (
+                    item.__class__.__name__, line, expected))
+            print '%-20s %11.3fs %11.3fs %7.2fx' % (
+                item.__class__.__name__, exporter_time, serializer_time,
+                exporter_time / serializer_time)
@@ -0,0 +1,27 @@
+from scrapy.command import ScrapyCommand
+from scrapy.exceptions import UsageError
+from scrapy.log import INFO, level_names
+
+
+def log(message, level=INFO):
+    print '%s: %s' % (level_names[level], message)
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+
+    def syntax(self):
+        return '<spider>'
+
+    def short_desc(self):
+        return 'Export the scraped data of a spider to the API'
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+
+        crawler = self.crawler_process.create_crawler()
+        spider = crawler.spiders.create(args[0])
+        if not spider.exporter_class:
+            raise UsageError('Spider %s has no exporter' % args[0])
+        spider.exporter_class(log=log).run_export()
@@ -1,12 +1,15 @@
 # -*- coding: utf8 -*-
-from scrapy.contrib.loader import ItemLoader
+from scrapy.contrib.loader import ItemLoader as BaseItemLoader
 from scrapy.contrib.loader.processor import TakeFirst, MapCompose, Compose
+from scrapy.utils.misc import arg_to_iter
+from scrapy.utils.python import flatten
 
 from datetime import datetime
 
 import pytz
 
 from visegrad.utils import MakeList
+from visegrad.selectors import CompiledSelector
 
 
 def translate(phrase, words_dict, allow_empty=False):
@@ -94,6 +97,27 @@ def pl_make_sitting_id(value):
     return 'sejm_posiedzenia_punkty/%s' % value
 
 
+class ItemLoader(BaseItemLoader):
+    """ItemLoader accepting also expressions compiled by visegrad.selectors
+    in add_xpath, add_css and their replace_ and get_ variants."""
+
+    def _select_values(self, queries, method):
+        self._check_selector_method()
+        values = []
+        for query in arg_to_iter(queries):
+            if isinstance(query, CompiledSelector):
+                values.append(query.select(self.selector).extract())
+            else:
+                values.append(getattr(self.selector, method)(query).extract())
+        return flatten(values)
+
+    def _get_xpathvalues(self, xpaths, **kw):
+        return self._select_values(xpaths, 'xpath')
+
+    def _get_cssvalues(self, csss, **kw):
+        return self._select_values(csss, 'css')
+
+
 class PersonLoader(ItemLoader):
     default_input_processor = MapCompose(strip)
     default_output_processor = TakeFirst()
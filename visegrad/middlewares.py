@@ -0,0 +1,69 @@
+import re
+
+from scrapy.contrib.downloadermiddleware.httpcache import HttpCacheMiddleware
+from scrapy.contrib.httpcache import RFC2616Policy
+from scrapy.exceptions import IgnoreRequest
+
+
+class PatternPolicy(RFC2616Policy):
+    """HTTP cache policy with freshness lifetimes set by the spider.
+
+    The spider's HTTPCACHE_POLICIES is a sequence of (url regex, seconds)
+    pairs, the first pattern found in the request url gives the lifetime of
+    the cached response. The request meta key httpcache_ttl overrides it
+    for single requests. Responses to other urls follow RFC 2616. Stale
+    responses are revalidated with conditional requests when the server
+    sent ETag or Last-Modified headers.
+    """
+
+    def __init__(self, settings):
+        super(PatternPolicy, self).__init__(settings)
+        self.policies = []
+
+    def set_spider(self, spider):
+        self.policies = [
+            (re.compile(pattern), ttl)
+            for pattern, ttl in getattr(spider, 'HTTPCACHE_POLICIES', ())]
+
+    def get_freshness_lifetime(self, request):
+        if 'httpcache_ttl' in request.meta:
+            return request.meta['httpcache_ttl']
+        for regex, ttl in self.policies:
+            if regex.search(request.url):
+                return ttl
+
+    def should_cache_response(self, response, request):
+        # RFC 2616 caches responses without expiration or validation headers
+        # only for some statuses, the spider's lifetime is enough here
+        if response.status == 200 and \
+                self.get_freshness_lifetime(request) is not None:
+            return True
+        return super(PatternPolicy, self).should_cache_response(
+            response, request)
+
+    def _compute_freshness_lifetime(self, response, request, now):
+        ttl = self.get_freshness_lifetime(request)
+        if ttl is None:
+            return super(PatternPolicy, self)._compute_freshness_lifetime(
+                response, request, now)
+        return ttl
+
+
+class PatternHttpCacheMiddleware(HttpCacheMiddleware):
+    """HttpCacheMiddleware which lets the cache policy know the spider."""
+
+    def spider_opened(self, spider):
+        super(PatternHttpCacheMiddleware, self).spider_opened(spider)
+        if hasattr(self.policy, 'set_spider'):
+            self.policy.set_spider(spider)
+
+
+class CancelRequestsMiddleware(object):
+    """Drops scheduled requests the spider no longer needs, i.e. those for
+    which its `is_cancelled(request)` method returns True."""
+
+    def process_request(self, request, spider):
+        is_cancelled = getattr(spider, 'is_cancelled', None)
+        if is_cancelled and is_cancelled(request):
+            spider.crawler.stats.inc_value('cancelled_requests')
+            raise IgnoreRequest()
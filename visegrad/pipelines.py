@@ -1,69 +1,542 @@
-from scrapy.exceptions import DropItem
+from scrapy.exceptions import DontCloseSpider, DropItem, NotConfigured
 from scrapy.conf import settings
 from scrapy import signals
 from scrapy.xlib.pydispatch import dispatcher
-from scrapy.contrib.exporter import JsonLinesItemExporter
-from scrapy.log import ERROR
+from scrapy.contrib.exporter import PythonItemExporter
+from scrapy.utils.serialize import ScrapyJSONEncoder
+from scrapy.utils.signal import send_catch_log
+from scrapy import log, logformatter
+from scrapy.log import ERROR, WARNING, DEBUG
+
+from twisted.internet import defer, reactor, threads
+
+from collections import defaultdict, deque
+
+from datetime import datetime
+
+import glob
+
+import hashlib
 
 import os
 
+import Queue
 
-class DuplicatesPipeline(object):
+import threading
+
+import time
+
+from visegrad import items
+from visegrad.serializers import JsonLinesSerializer
+from visegrad.signals import export_finished, writer_backpressure
+from visegrad.utils import get_compression_extension, open_output, \
+    remove_output_file, save_json_file, chunks
+from visegrad.storage import fingerprint, FingerprintSet, \
+    DiskFingerprintSet, SeenStore, MergeStore, VoteStore
+
+
+def get_item_key(item):
+    """Returns "scheme/identifier" key of items with identifiers."""
+    if 'identifiers' not in item:
+        return None
+    if type(item['identifiers']) is list:
+        identifier = item['identifiers'][0]
+        k = identifier['identifier']
+        scheme = identifier.get('scheme')
+        if scheme:
+            k = "%s/%s" % (scheme, k)
+    else:
+        k = item['identifiers']
+    if isinstance(k, unicode):
+        k = k.encode('utf-8')
+    return k
+
+
+class ItemMerged(DropItem):
+    """Raised for items held by MergePipeline until the spider closes."""
+
+
+class LogFormatter(logformatter.LogFormatter):
+    def dropped(self, item, exception, response, spider):
+        entry = super(LogFormatter, self).dropped(
+            item, exception, response, spider)
+        if isinstance(exception, ItemMerged):
+            entry['level'] = DEBUG
+        return entry
+
+
+def merge_items(item, other):
+    """Fills fields of `item` missing in it from `other` and extends its
+    list fields with the values it does not contain yet.
+    """
+    for field, value in other.iteritems():
+        current = item.get(field)
+        if current in (None, '', []):
+            item[field] = value
+        elif isinstance(current, list) and isinstance(value, list):
+            item[field] = current + [v for v in value if v not in current]
+    return item
+
+
+class MergePipeline(object):
+    """Merges all items with the same key into one item, which is passed to
+    the following pipelines once, when the spider gets idle. Items without
+    identifiers and items scraped after that are passed through.
+
+    The merged items are reported by the item_scraped or item_dropped
+    signals like the other items. The copies held are counted only in the
+    item_dropped_reasons_count/ItemMerged stat, not in item_dropped_count.
+
+    With STREAMING_EXPORT, the first copy of each item is passed on at once,
+    so the items referring to it can be exported while crawling. Items
+    merged with later copies are passed on again when the spider gets idle,
+    bypassing DuplicatesPipeline, to update the exported ones. The updates
+    are not reported again.
+    """
     def __init__(self):
-        self.items_seen = set()
+        self.store = None
+        self.flushing = None
+        self.flushed = False
+        self.streaming = bool(settings.get('STREAMING_EXPORT'))
+
+        dispatcher.connect(self.spider_idle, signals.spider_idle)
+
+    def open_spider(self, spider):
+        filename = os.path.join(
+            settings.get('OUTPUT_PATH', ''), spider.name, 'merge.sqlite')
+        self.store = MergeStore(
+            filename, settings.getint('MERGE_MEMORY_LIMIT', 100000))
+
+    def spider_idle(self, spider):
+        # the following pipelines must get the merged items before they are
+        # closed, so the spider is kept open until all of them are passed on
+        if self.flushing is None:
+            self.flushing = self.flush(spider).addErrback(
+                log.err, 'Passing merged items on failed', spider=spider)
+        if not self.flushed:
+            raise DontCloseSpider()
+
+    def close_spider(self, spider):
+        if not self.flushed:
+            spider.log('%d merged items were not passed on, the spider was '
+                       'closed before it got idle' % len(self.store), WARNING)
+        self.store.close()
+
+    @defer.inlineCallbacks
+    def flush(self, spider):
+        pipelines = spider.crawler.engine.scraper.itemproc.middlewares
+        pipelines = pipelines[pipelines.index(self) + 1:]
+        if self.streaming:
+            pipelines = [p for p in pipelines
+                         if not isinstance(p, DuplicatesPipeline)]
+        stats = spider.crawler.stats
+        send = spider.crawler.signals.send_catch_log_deferred
+
+        try:
+            for key, record in self.store:
+                item_class, fields, copies = record
+                if self.streaming and copies == 1:
+                    # passed on already, there is nothing to update
+                    continue
+                item = getattr(items, item_class)(fields)
+                stats.inc_value('merge/items')
+                try:
+                    for pipeline in pipelines:
+                        item = yield defer.maybeDeferred(
+                            pipeline.process_item, item, spider)
+                except DropItem, e:
+                    stats.inc_value('merge/items_dropped')
+                    if not self.streaming:
+                        yield send(
+                            signal=signals.item_dropped, item=item,
+                            response=None, spider=spider, exception=e)
+                except Exception:
+                    log.err(_why='Processing merged item %s failed' % key,
+                            spider=spider)
+                else:
+                    if not self.streaming:
+                        yield send(
+                            signal=signals.item_scraped, item=item,
+                            response=None, spider=spider)
+        finally:
+            self.flushed = True
+
+    def merge(self, record, other):
+        item_class, item, copies = record
+        return [item_class, merge_items(item, other[1]), copies + other[2]]
 
     def process_item(self, item, spider):
-        if 'identifiers' in item:
-            if type(item['identifiers']) is list:
-                identifier = item['identifiers'][0]
-                k = identifier['identifier']
-                scheme = identifier.get('scheme')
-                if scheme:
-                    k = "%s/%s" % (scheme, k)
-            else:
-                k = item['identifiers']
-            t = (type(item), k)
+        k = get_item_key(item)
+        if k is None or self.flushing is not None:
+            return item
+
+        item_class = item.__class__.__name__
+        first = self.store.merge(
+            '%s/%s' % (item_class, k), [item_class, dict(item), 1],
+            self.merge)
+        if first and self.streaming:
+            return item
+        # the copy is counted when the merged item is scraped or dropped
+        spider.crawler.stats.inc_value('item_dropped_count', -1)
+        raise ItemMerged()
 
-            if t in self.items_seen:
+
+class DuplicatesPipeline(object):
+    """Drops items with keys which were already passed on, i.e. items
+    scraped after MergePipeline passed on the merged ones.
+    """
+    def __init__(self):
+        self.items_seen = None
+
+    def open_spider(self, spider):
+        if settings.get('DUPLICATES_STORAGE', 'memory') == 'disk':
+            filename = os.path.join(
+                settings.get('OUTPUT_PATH', ''), spider.name,
+                'duplicates.sqlite')
+            self.items_seen = DiskFingerprintSet(filename)
+        else:
+            self.items_seen = FingerprintSet()
+
+    def close_spider(self, spider):
+        seen = len(self.items_seen)
+        nbytes = self.items_seen.nbytes
+        stats = spider.crawler.stats
+        stats.set_value('duplicates/items_seen', seen)
+        stats.set_value('duplicates/bytes', nbytes)
+        if seen:
+            stats.set_value('duplicates/bytes_per_item', nbytes / seen)
+        self.items_seen.close()
+
+    def process_item(self, item, spider):
+        k = get_item_key(item)
+        if k is not None:
+            fp = fingerprint('%s/%s' % (item.__class__.__name__, k))
+            if not self.items_seen.add(fp):
                 raise DropItem()
-            self.items_seen.add(t)
         return item
 
 
+class SeenStorePipeline(object):
+    """Drops items which are identical to the ones scraped by the previous
+    successfully exported run. Items with identifiers are tracked by their
+    key, so their changed versions are exported again. Other items are
+    tracked by their content only, so they are forgotten once they are not
+    scraped by two successful runs.
+    """
+    def __init__(self):
+        if not settings.get('SEEN_STORE_ENABLED'):
+            raise NotConfigured()
+        self.store = None
+        self.encoder = ScrapyJSONEncoder(sort_keys=True)
+
+        dispatcher.connect(self.export_finished, export_finished)
+
+    def open_spider(self, spider):
+        filename = os.path.join(
+            settings.get('OUTPUT_PATH', ''), spider.name, 'seen.sqlite')
+        self.store = SeenStore(
+            filename, settings.getint('SEEN_STORE_BATCH', 1000))
+        self.timestamp = int(time.time())
+
+    def export_finished(self, spider, status):
+        if status == 'finished':
+            self.store.commit()
+        else:
+            self.store.rollback()
+        self.store.close()
+
+    def process_item(self, item, spider):
+        digest = hashlib.sha1(self.encoder.encode(item)).hexdigest()
+        k = get_item_key(item)
+        if k is None:
+            k = digest
+        k = '%s/%s' % (item.__class__.__name__, k)
+
+        unchanged = self.store.get_hash(k) == digest
+        self.store.add(k, digest, self.timestamp)
+        if unchanged:
+            spider.crawler.stats.inc_value('seen_store/unchanged')
+            raise DropItem()
+        return item
+
+
+SHARD_KEY_FIELDS = ('identifier', 'vote_event_id', 'event_id')
+
+
+def get_shard_key(item):
+    k = get_item_key(item)
+    if k is None:
+        for field in SHARD_KEY_FIELDS:
+            if item.get(field):
+                return item[field]
+    return k
+
+
+class ItemFile(object):
+    """JSON lines output of items of one class. When `max_items` or
+    `max_bytes` is given, the output is split to numbered shards of at most
+    that many items or bytes (Vote.000.json, Vote.001.json, ...).
+    """
+    def __init__(self, directory, name, compression=None,
+                 buffer_size=1 << 20, max_items=0, max_bytes=0):
+        self.directory = directory
+        self.name = name
+        self.compression = compression
+        self.extension = get_compression_extension(compression)
+        self.buffer_size = buffer_size
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sharded = bool(max_items or max_bytes)
+        self.shards = []
+        self.file = None
+
+    def get_filename(self, index):
+        if self.sharded:
+            filename = '%s.%03d.json' % (self.name, index)
+        else:
+            filename = '%s.json' % self.name
+        return filename + self.extension
+
+    def remove_previous(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        remove_output_file(os.path.join(self.directory, self.name + '.json'))
+        pattern = os.path.join(
+            self.directory, self.name + '.[0-9][0-9][0-9].json*')
+        for filename in glob.glob(pattern):
+            os.remove(filename)
+
+    def open_shard(self):
+        if not self.shards:
+            self.remove_previous()
+        filename = self.get_filename(len(self.shards))
+        self.file = open_output(
+            os.path.join(self.directory, filename),
+            self.compression, self.buffer_size)
+        self.shards.append({
+            'file': filename,
+            'items': 0,
+            'first_key': None,
+            'last_key': None,
+        })
+
+    def close_shard(self):
+        self.file.close()
+        self.file = None
+
+    def is_full(self):
+        shard = self.shards[-1]
+        if self.max_items and shard['items'] >= self.max_items:
+            return True
+        return self.max_bytes and self.file.tell() >= self.max_bytes
+
+    def export_item(self, item):
+        if self.file is not None and self.is_full():
+            self.close_shard()
+        if self.file is None:
+            self.open_shard()
+        self.file.write(JsonLinesSerializer.for_class(item.__class__)(item))
+
+        shard = self.shards[-1]
+        shard['items'] += 1
+        k = get_shard_key(item)
+        if k is not None:
+            if shard['first_key'] is None or k < shard['first_key']:
+                shard['first_key'] = k
+            if shard['last_key'] is None or k > shard['last_key']:
+                shard['last_key'] = k
+
+    def close(self):
+        if self.file is not None:
+            self.close_shard()
+
+
+class VoteFile(object):
+    """Votes kept in a compact VoteStore (Vote.bin with Vote.tables.json).
+    Votes with fields the store does not keep are written to `fallback`.
+    """
+    def __init__(self, directory, fallback, compression=None,
+                 buffer_size=1 << 20):
+        self.directory = directory
+        self.fallback = fallback
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.filename = 'Vote.bin' + get_compression_extension(compression)
+        self.store = None
+
+    @property
+    def shards(self):
+        shards = list(self.fallback.shards)
+        if self.store:
+            shards.append({
+                'file': self.filename,
+                'items': self.store.count,
+                'format': 'compact',
+            })
+        return shards
+
+    def open(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        remove_output_file(os.path.join(self.directory, 'Vote.bin'))
+        self.store = VoteStore(
+            os.path.join(self.directory, self.filename),
+            os.path.join(self.directory, 'Vote.tables.json'))
+        self.store.open(self.compression, self.buffer_size)
+
+    def export_item(self, item):
+        if any(field not in VoteStore.FIELDS for field in item):
+            self.fallback.export_item(item)
+            return
+        if self.store is None:
+            self.open()
+        self.store.add(item)
+
+    def close(self):
+        self.fallback.close()
+        if self.store:
+            self.store.close()
+
+
+class BackgroundWriter(object):
+    """Exports items to `output` (ItemFile or VoteFile) in a thread. Items
+    are passed through a queue of at most `queue_size` items; while the
+    queue is full, put() returns a Deferred fired once the item is queued,
+    so Scrapy holds the crawl back until the writer catches up without
+    blocking the reactor.
+    """
+    def __init__(self, output, queue_size):
+        self.output = output
+        self.queue = Queue.Queue(queue_size)
+        # (entry, deferred) pairs waiting for free slots in the queue
+        self.blocked = deque()
+        self.max_lag = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            if self.blocked:
+                reactor.callFromThread(self.release)
+            if entry is None:
+                break
+            item, enqueued = entry
+            if self.error is None:
+                try:
+                    self.output.export_item(item)
+                except Exception, e:
+                    self.error = e
+            self.max_lag = max(self.max_lag, time.time() - enqueued)
+        self.output.close()
+
+    def put(self, item):
+        """Queues `item`. Returns None or, when the queue is full, a Deferred
+        fired with the number of seconds the item waited for a free slot.
+        """
+        if self.error is not None:
+            raise self.error
+        entry = (item, time.time())
+        if not self.blocked:
+            try:
+                self.queue.put_nowait(entry)
+                return None
+            except Queue.Full:
+                pass
+        dfd = defer.Deferred()
+        self.blocked.append((entry, dfd))
+        # the writer may have taken an item before it saw this one waiting
+        self.release()
+        return dfd
+
+    def release(self):
+        """Moves waiting items to the queue while it has free slots."""
+        while self.blocked:
+            entry, dfd = self.blocked[0]
+            try:
+                self.queue.put_nowait(entry)
+            except Queue.Full:
+                return
+            self.blocked.popleft()
+            dfd.callback(time.time() - entry[1])
+
+    def close(self):
+        while self.blocked:
+            entry, dfd = self.blocked.popleft()
+            self.queue.put(entry)
+            dfd.callback(time.time() - entry[1])
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
 class ExportPipeline(object):
+    MANIFEST_FILE = 'manifest.json'
+
     def __init__(self):
         self.files = {}
-        self.exporters = {}
+        self.writers = {}
+        self.queue_size = settings.getint('OUTPUT_QUEUE_SIZE', 10000)
+        self.compression = settings.get('OUTPUT_COMPRESSION')
+        get_compression_extension(self.compression)
+        self.run = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
 
         dispatcher.connect(self.spider_closed, signals.spider_closed)
 
-    def get_filename(self, spider, item):
-        directory = spider.name
-        item_file = item.__class__.__name__ + '.json'
-        return os.path.join(settings.get('OUTPUT_PATH', ''), directory, item_file)
+    def get_directory(self, spider):
+        return os.path.join(settings.get('OUTPUT_PATH', ''), spider.name)
 
     def get_file(self, spider, item):
-        filename = self.get_filename(spider, item)
-        if filename not in self.files:
-            dirs, f = os.path.split(filename)
-            if not os.path.exists(dirs):
-                os.makedirs(dirs)
-            self.files[filename] = open(filename, "wb")
-        return self.files[filename]
-
-    def get_exporter(self, spider, item):
-        filename = self.get_filename(spider, item)
-        if filename not in self.exporters:
-            f = self.get_file(spider, item)
-            self.exporters[filename] = JsonLinesItemExporter(f)
-            self.exporters[filename].start_exporting()
-        return self.exporters[filename]
+        name = item.__class__.__name__
+        if name not in self.files:
+            buffer_size = settings.getint('OUTPUT_BUFFER_SIZE', 1 << 20)
+            f = ItemFile(
+                self.get_directory(spider),
+                name,
+                compression=self.compression,
+                buffer_size=buffer_size,
+                max_items=settings.getint('OUTPUT_SHARD_ITEMS', 0),
+                max_bytes=settings.getint('OUTPUT_SHARD_BYTES', 0),
+            )
+            if name == 'Vote' and settings.get('COMPACT_VOTES'):
+                f = VoteFile(
+                    self.get_directory(spider), f,
+                    compression=self.compression, buffer_size=buffer_size)
+            self.files[name] = f
+        return self.files[name]
+
+    def get_writer(self, spider, item):
+        name = item.__class__.__name__
+        if name not in self.writers:
+            self.writers[name] = BackgroundWriter(
+                self.get_file(spider, item), self.queue_size)
+        return self.writers[name]
+
+    def write_manifest(self, spider, status):
+        manifest = {
+            'run': self.run,
+            'status': status,
+            'files': dict(
+                (name, f.shards) for name, f in self.files.iteritems()),
+        }
+        save_json_file(
+            os.path.join(self.get_directory(spider), self.MANIFEST_FILE),
+            manifest)
 
     def spider_closed(self, spider, reason):
-        for filename in self.files:
-            if filename in self.exporters:
-                self.exporters[filename].finish_exporting()
-            self.files[filename].close()
+        stats = spider.crawler.stats
+        for name, writer in self.writers.iteritems():
+            try:
+                writer.close()
+            except Exception, e:
+                spider.log('Writing %s failed: %s' % (name, e), ERROR)
+            stats.max_value('export/writer_lag_max', writer.max_lag)
+        for name, f in self.files.iteritems():
+            if name not in self.writers:
+                f.close()
 
         status = 'finished' if reason == 'finished' else 'failed'
 
@@ -73,16 +546,155 @@ class ExportPipeline(object):
         if max_errors and errors_count >= max_errors:
             status = 'failed'
 
-        if status == 'finished' and spider.exporter_class:
+        self.write_manifest(spider, status)
+
+        if status == 'finished' and spider.exporter_class and \
+                settings.getbool('EXPORT_ENABLED', True) and \
+                not settings.get('STREAMING_EXPORT'):
             exporter = spider.exporter_class(log=spider.log)
             try:
                 exporter.run_export()
             except Exception, e:
                 spider.log(e.message, ERROR)
                 status = 'failed'
+        send_catch_log(signal=export_finished, spider=spider, status=status)
         spider.log_finish(status)
 
     def process_item(self, item, spider):
-        self.get_exporter(spider, item).export_item(item)
+        if not self.queue_size:
+            self.get_file(spider, item).export_item(item)
+            return item
+
+        writer = self.get_writer(spider, item)
+        dfd = writer.put(item)
+
+        stats = spider.crawler.stats
+        stats.max_value('export/queue_depth_max', writer.queue.qsize())
+        if dfd is None:
+            return item
+
+        def queued(waited):
+            stats.inc_value('export/backpressure_time', waited)
+            send_catch_log(
+                signal=writer_backpressure, spider=spider,
+                item_class=item.__class__.__name__, waited=waited)
+            return item
+
+        stats.inc_value('export/backpressure_count')
+        return dfd.addCallback(queued)
+
+
+class StreamingExportPipeline(object):
+    """Exports items to the API in batches while the spider is crawling,
+    instead of after it is closed. Items referring to items which were not
+    exported yet are held until those are exported. Items still waiting
+    when the spider closes are exported with references looked up in the
+    API.
+    """
+    SOURCES = {
+        'Person': 'people',
+        'SkupstinaMePerson': 'people',
+        'Organization': 'organizations',
+        'Membership': 'memberships',
+        'Event': 'events',
+        'Motion': 'motions',
+        'VoteEvent': 'vote-events',
+        'Vote': 'votes',
+        'Speech': 'speeches',
+    }
+    # sources in the order VisegradApiExport.run_export exports them
+    EXPORT_ORDER = (
+        'people', 'organizations', 'memberships', 'events', 'motions',
+        'vote-events', 'votes', 'speeches')
+
+    def __init__(self):
+        if not settings.get('STREAMING_EXPORT'):
+            raise NotConfigured()
+        self.batch_size = settings.getint('STREAMING_EXPORT_BATCH', 400)
+        self.batch = []
+        self.waiting = defaultdict(list)
+        self.lock = defer.DeferredLock()
+        self.item_exporter = PythonItemExporter()
+
+    def open_spider(self, spider):
+        self.spider = spider
+        self.exporter = spider.exporter_class(log=spider.log)
+        self.lock.run(
+            threads.deferToThread, self.exporter.sync_all_reference_data
+        ).addErrback(self.log_failure)
+
+    def close_spider(self, spider):
+        self.flush()
+        return self.lock.run(
+            threads.deferToThread, self.export_waiting
+        ).addErrback(self.log_failure)
 
+    def process_item(self, item, spider):
+        source = self.SOURCES[item.__class__.__name__]
+        self.batch.append((source, self.item_exporter.export_item(item)))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
         return item
+
+    def log_failure(self, failure):
+        self.spider.log('Streaming export failed: %s' % failure, ERROR)
+
+    def flush(self):
+        batch, self.batch = self.batch, []
+        self.lock.run(
+            threads.deferToThread, self.export_batch, batch
+        ).addErrback(self.log_failure)
+
+    def export_batch(self, batch):
+        """Exports items of `batch` whose references are resolved and the
+        items waiting for them. Runs in a thread, one batch at a time.
+        """
+        queue = deque(batch)
+        votes = []
+        while queue:
+            source, item = queue.popleft()
+            missing = self.get_missing_dependency(source, item)
+            if missing:
+                self.waiting[missing].append((source, item))
+            elif source == 'votes':
+                votes.append(item)
+            else:
+                for key in self.exporter.export_item(source, item):
+                    queue.extend(self.waiting.pop(key, []))
+        for votes_chunk in chunks(votes, 400):
+            self.exporter.export_votes_chunk(votes_chunk)
+
+    def get_missing_dependency(self, source, item):
+        for key in self.exporter.get_dependencies(source, item):
+            # look references up in the API only once, items waiting for
+            # them are released when they are exported
+            lookup = key not in self.waiting
+            if not self.exporter.is_exported(key, lookup=lookup):
+                return key
+
+    def export_waiting(self):
+        """Exports items waiting for items which were not scraped, in the
+        order of their sources and parents before their children, so items
+        waiting for each other are exported after the ones they refer to.
+        """
+        waiting = []
+        for key, items in self.waiting.items():
+            self.spider.log('Exporting %d items waiting for %s' % (
+                len(items), '/'.join(key)), WARNING)
+            waiting.extend(items)
+        waiting.sort(key=lambda (source, item): (
+            self.EXPORT_ORDER.index(source), 'parent_id' in item))
+
+        votes = []
+        for source, item in waiting:
+            if source == 'votes':
+                votes.append(item)
+                continue
+            try:
+                self.exporter.export_item(source, item)
+            except KeyError, e:
+                self.spider.log('%s item refers to unknown %s' % (
+                    source, e), WARNING)
+        for votes_chunk in chunks(votes, 400):
+            self.exporter.export_votes_chunk(votes_chunk)
+        self.waiting.clear()
@@ -0,0 +1,83 @@
+"""XPath and CSS expressions compiled once for selectors used in loops.
+
+Spiders keep the compiled expressions as class attributes, e.g.::
+
+    VOTE_ROWS = css('#szav-nev-szerint tr')
+
+and use them with `select(response, self.VOTE_ROWS)` or pass them to
+add_xpath and add_css of the loaders in visegrad.loaders.
+"""
+from lxml import etree
+
+from scrapy.selector import SelectorList
+from scrapy.selector.csstranslator import ScrapyHTMLTranslator
+
+
+# namespaces Scrapy selectors register for XPath expressions
+NAMESPACES = {
+    're': 'http://exslt.org/regular-expressions',
+    'set': 'http://exslt.org/sets',
+}
+
+_css_translator = ScrapyHTMLTranslator()
+_compiled = {}
+
+
+class CompiledSelector(object):
+    """XPath expression `xpath_query` compiled by lxml, `query` is the
+    original XPath or CSS expression."""
+
+    def __init__(self, query, xpath_query):
+        self.query = query
+        self.xpath_query = xpath_query
+        self._xpath = etree.XPath(
+            xpath_query, namespaces=NAMESPACES, smart_strings=False)
+
+    def select(self, selector):
+        """Returns SelectorList of results of the expression evaluated in
+        `selector`, which may be a Selector, SelectorList or response."""
+        if isinstance(selector, SelectorList):
+            return SelectorList(
+                result for s in selector for result in self.select(s))
+        if hasattr(selector, 'selector'):
+            # response
+            selector = selector.selector
+
+        if not hasattr(selector._root, 'xpath'):
+            return SelectorList([])
+        result = self._xpath(selector._root)
+        if type(result) is not list:
+            result = [result]
+        return SelectorList(
+            selector.__class__(_root=x, _expr=self.query,
+                namespaces=selector.namespaces, type=selector.type)
+            for x in result)
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.query)
+
+
+def xpath(query):
+    """Returns the XPath expression `query` compiled."""
+    key = ('xpath', query)
+    if key not in _compiled:
+        _compiled[key] = CompiledSelector(query, query)
+    return _compiled[key]
+
+
+def css(query):
+    """Returns the CSS expression `query` translated to XPath and compiled.
+    Scrapy's ::text and ::attr() pseudo-elements are supported."""
+    key = ('css', query)
+    if key not in _compiled:
+        _compiled[key] = CompiledSelector(
+            query, _css_translator.css_to_xpath(query))
+    return _compiled[key]
+
+
+def select(selector, query):
+    """Evaluates `query`, a compiled expression or an XPath string, in
+    `selector`."""
+    if isinstance(query, CompiledSelector):
+        return query.select(selector)
+    return selector.xpath(query)
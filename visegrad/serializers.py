@@ -1,6 +1,38 @@
+from scrapy.utils.serialize import ScrapyJSONEncoder
+
+
 class IdentifiersSerializer(object):
     def __init__(self, scheme):
         self.scheme = scheme
 
     def __call__(self, value):
         return [{'identifier': value, 'scheme': self.scheme}]
+
+
+class JsonLinesSerializer(object):
+    """Serializes items of `item_class` to JSON lines like
+    JsonLinesItemExporter, but with the field serializers declared in the
+    item class looked up once instead of for every field of every item.
+    """
+    _serializers = {}
+
+    def __init__(self, item_class):
+        self.field_serializers = [
+            (name, field['serializer'])
+            for name, field in item_class.fields.iteritems()
+            if 'serializer' in field
+        ]
+        self.encode = ScrapyJSONEncoder().encode
+
+    @classmethod
+    def for_class(cls, item_class):
+        if item_class not in cls._serializers:
+            cls._serializers[item_class] = cls(item_class)
+        return cls._serializers[item_class]
+
+    def __call__(self, item):
+        values = dict(item)
+        for name, serializer in self.field_serializers:
+            if name in values:
+                values[name] = serializer(values[name])
+        return self.encode(values) + '\n'
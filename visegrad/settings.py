@@ -10,14 +10,63 @@ BOT_NAME = 'visegrad'
 
 SPIDER_MODULES = ['visegrad.spiders']
 NEWSPIDER_MODULE = 'visegrad.spiders'
+COMMANDS_MODULE = 'visegrad.commands'
 
 ITEM_PIPELINES = {
+    'visegrad.pipelines.MergePipeline': 700,
     'visegrad.pipelines.DuplicatesPipeline': 800,
+    'visegrad.pipelines.SeenStorePipeline': 850,
     'visegrad.pipelines.ExportPipeline': 900,
+    'visegrad.pipelines.StreamingExportPipeline': 950,
 }
 
+DOWNLOADER_MIDDLEWARES = {
+    'visegrad.middlewares.CancelRequestsMiddleware': 50,
+    'scrapy.contrib.downloadermiddleware.httpcache.HttpCacheMiddleware': None,
+    'visegrad.middlewares.PatternHttpCacheMiddleware': 900,
+}
+
+LOG_FORMATTER = 'visegrad.pipelines.LogFormatter'
+
+# cache responses, their freshness is given by HTTPCACHE_POLICIES of the
+# spider, see visegrad.middlewares.PatternPolicy
+HTTPCACHE_ENABLED = 1
+HTTPCACHE_POLICY = 'visegrad.middlewares.PatternPolicy'
+
 OUTPUT_PATH = 'data'
 
+# compression of the scraped data files, None, 'gzip' or 'zstd' (requires
+# the zstandard package)
+OUTPUT_COMPRESSION = None
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# items waiting for the background writer of each data file, the crawl
+# waits when the queue is full. 0 writes the items in the reactor thread
+OUTPUT_QUEUE_SIZE = 10000
+
+# store votes in a compact binary file with tables of interned vote events,
+# voters and options instead of Vote.json
+COMPACT_VOTES = 0
+
+# split the scraped data files to shards of at most this many items or
+# bytes, 0 means no limit
+OUTPUT_SHARD_ITEMS = 0
+OUTPUT_SHARD_BYTES = 0
+
+# number of merged items MergePipeline keeps in memory before spilling
+# them to disk
+MERGE_MEMORY_LIMIT = 100000
+
+# where DuplicatesPipeline keeps fingerprints of seen items, 'memory' or
+# 'disk' for crawls too large to fit in memory
+DUPLICATES_STORAGE = 'memory'
+
+# drop items identical to the ones exported by the previous run
+SEEN_STORE_ENABLED = 0
+
+# number of seen items written to the store at once
+SEEN_STORE_BATCH = 1000
+
 RANDOMIZE_DOWNLOAD_DELAY = True
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -27,6 +76,35 @@ CLOSESPIDER_ERRORCOUNT = 1
 
 CRAWL_LATEST_ONLY = 0
 
+# when crawling the latest data only, API data of people fetched by a
+# previous run less than this many seconds ago is not fetched again (their
+# pages with speeches and memberships still are)
+PERSON_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Hungarian votes are requested in date windows of VOTES_WINDOW_DAYS days;
+# on the next run windows whose responses had more than VOTES_WINDOW_MAX_SIZE
+# bytes are split and consecutive windows with less than VOTES_WINDOW_MIN_SIZE
+# bytes are merged
+VOTES_WINDOW_DAYS = 60
+VOTES_WINDOW_MAX_SIZE = 2 * 1024 * 1024
+VOTES_WINDOW_MIN_SIZE = 64 * 1024
+
+# export the scraped data to the API when the crawl finishes, disabled for
+# shards of backfills which are exported after they are merged
+EXPORT_ENABLED = 1
+
+# export items to the API in batches of STREAMING_EXPORT_BATCH items while
+# crawling instead of exporting all of them after the crawl
+STREAMING_EXPORT = 0
+STREAMING_EXPORT_BATCH = 400
+
+# skip shards of the scraped data already exported by a failed export
+EXPORT_RESUME = 0
+
+# upsert reference data (e.g. chambers) even if it did not change since
+# the last export
+FORCE_REFERENCE_DATA_SYNC = 0
+
 try:
     import json
     import os.path
@@ -0,0 +1,9 @@
+"""Signals sent by visegrad pipelines in addition to Scrapy signals."""
+
+# sent after the export of a crawl has finished or failed. Arguments:
+# spider, status ('finished' or 'failed')
+export_finished = object()
+
+# sent when ExportPipeline had to wait for a writer to catch up with the
+# crawl. Arguments: spider, item_class, waited (seconds)
+writer_backpressure = object()
@@ -5,14 +5,20 @@ from scrapy.xlib.pydispatch import dispatcher
 
 from datetime import datetime
 
+import os
+
 import vpapi
 
+from visegrad.signals import export_finished
+from visegrad.utils import load_json_file, save_json_file
+
 
 class VisegradSpider(scrapy.Spider):
     exporter_class = None
     user = 'scraper'
     parliament_code = ''
     latest_dates = {}
+    STATE_FILE = 'spider-state.json'
 
     def __init__(self, *args, **kwargs):
         super(VisegradSpider, self).__init__(*args, **kwargs)
@@ -20,11 +26,32 @@ class VisegradSpider(scrapy.Spider):
         vpapi.parliament(self.get_parliament())
         vpapi.authorize(self.get_user(), self.get_password())
 
+        # data kept between runs, saved only when the export succeeds. Not
+        # `state`, Scrapy's SpiderState extension replaces that attribute
+        # when the spider is opened
+        self.crawl_state = load_json_file(self.get_state_filename(), {})
+
         dispatcher.connect(self.spider_opened, signals.spider_opened)
+        dispatcher.connect(self.export_finished, export_finished)
 
     def spider_opened(self, spider):
         self.log_start()
 
+    @classmethod
+    def get_backfill_shards(cls):
+        """Returns names of the shards a historic crawl is split to, each
+        crawled by a separate process with the spider argument `shard`.
+        """
+        return []
+
+    def export_finished(self, spider, status):
+        if spider is self and status == 'finished':
+            save_json_file(self.get_state_filename(), self.crawl_state)
+
+    def get_state_filename(self):
+        return os.path.join(
+            settings.get('OUTPUT_PATH', ''), self.name, self.STATE_FILE)
+
     def log_start(self):
         log_item = {
             'status': 'running'
@@ -5,12 +5,10 @@ from scrapy.exceptions import DropItem
 from urllib import urlencode
 from urlparse import urlparse
 
-from datetime import datetime
+from datetime import date, datetime
 
 import json
 
-import uuid
-
 from visegrad.spiders import VisegradSpider
 from visegrad.loaders import MojePanstwoPersonLoader, OrganizationLoader, \
     MojePanstwoMembershipLoader, MojePanstwoVoteEventLoader, \
@@ -20,6 +18,7 @@ from visegrad.items import Person, Organization, Membership, VoteEvent, Vote, \
     Motion, Count, Speech, Event
 from visegrad.loaders import pl_make_session_id, pl_make_sitting_id
 from visegrad.api.parliaments import SejmPlApiExport
+from visegrad.utils import ijson, iter_json_values
 
 
 class MojepanstwoPlSpider(VisegradSpider):
@@ -30,61 +29,155 @@ class MojepanstwoPlSpider(VisegradSpider):
     parliament_code = 'PL_SEJM'
     exporter_class = SejmPlApiExport
 
+    # layers of objects the spider needs, by dataset: (value of the layers
+    # parameter, layer which must be in the object)
+    LAYERS = {
+        'poslowie': ('info', 'info'),
+        'sejm_glosowania': ('*', 'wynikiIndywidualne'),
+        'sejm_wystapienia': ('html', 'html'),
+    }
+
+    # parts of search results decoded by iter_search
+    SEARCH_PREFIXES = ('search.pagination', 'search.dataobjects.item')
+    # parts of vote event objects decoded by parse_vote_event_stream
+    VOTES_PREFIX = 'object.layers.wynikiIndywidualne.item'
+    VOTE_EVENT_PREFIXES = ('object.id', 'object.data', VOTES_PREFIX)
+
+    # date fields of the datasets crawled incrementally
+    DATE_FIELDS = {
+        'sejm_glosowania': 'sejm_glosowania.czas',
+        'sejm_wystapienia': 'sejm_wystapienia.data',
+    }
+
+    def __init__(self, *args, **kwargs):
+        super(MojepanstwoPlSpider, self).__init__(*args, **kwargs)
+        # last pages of searches crossing the date of the latest data
+        self.search_cutoffs = {}
+        # paths of objects requested or parsed from search results
+        self.requested_objects = set()
+        # sessions which ended before previous runs, they do not change
+        self.closed_sessions = set(
+            self.crawl_state.get('closed_sessions', []))
+
     def start_requests(self):
-        yield scrapy.Request(
-            self.get_api_url(
-                '/dane/dataset/poslowie/search.json',
-                limit=self.page_limit),
-            callback=self.parse_people,
-        )
-        yield scrapy.Request(
-            self.get_api_url(
-                '/dane/dataset/sejm_komisje/search.json',
-                limit=self.page_limit),
-            callback=self.parse_committees,
-        )
-        yield scrapy.Request(
-            self.get_api_url(
-                '/dane/dataset/sejm_glosowania/search.json',
-                limit=self.page_limit),
-            callback=self.parse_vote_events,
-        )
-        yield scrapy.Request(
-            self.get_api_url(
-                '/dane/dataset/sejm_wystapienia/search.json',
-                limit=self.page_limit),
-            callback=self.parse_speeches
+        yield self.get_search_request('poslowie', self.parse_people)
+        yield self.get_search_request('sejm_komisje', self.parse_committees)
+        yield self.get_search_request(
+            'sejm_glosowania', self.parse_vote_events)
+        yield self.get_search_request('sejm_wystapienia', self.parse_speeches)
+        yield self.get_search_request(
+            'sejm_posiedzenia_punkty', self.parse_sittings)
+
+    def get_search_request(self, dataset, callback, page=1):
+        params = {'limit': self.page_limit}
+        if page > 1:
+            params['page'] = page
+        if dataset in self.LAYERS:
+            # objects are parsed from the search results when the API
+            # returns their layers
+            params['layers'] = self.LAYERS[dataset][0]
+        if dataset in self.DATE_FIELDS:
+            # newest objects first and, when crawling the latest data only,
+            # no objects older than the stop date. The dates are checked by
+            # the callbacks too, in case the API ignores the conditions
+            field = self.DATE_FIELDS[dataset]
+            params['order'] = '%s desc' % field
+            stop_date = self.get_stop_date(dataset)
+            if stop_date:
+                params['conditions[%s]' % field] = \
+                    '[%s TO *]' % stop_date.isoformat()
+        return scrapy.Request(
+            self.get_api_url('/dane/dataset/%s/search.json' % dataset,
+                **params),
+            callback=callback,
+            meta={'dataset': dataset, 'page': page},
+            # earlier pages first, they are needed first by cutoffs
+            priority=-page
         )
 
-        yield scrapy.Request(
-            self.get_api_url(
-                'dane/dataset/sejm_posiedzenia_punkty/search.json',
-                limit=self.page_limit),
-            callback=self.parse_sittings
-        )
+    def get_stop_date(self, dataset):
+        if dataset == 'sejm_glosowania':
+            return self.get_latest_vote_event_date()
+        if dataset == 'sejm_wystapienia':
+            return self.get_latest_speech_date()
+
+    def paginate(self, response, pagination, callback):
+        """Requests all the other pages of a search when its first page is
+        parsed, so they are downloaded concurrently."""
+        if response.meta.get('page', 1) != 1:
+            return
+        pages = -(-pagination['total'] // self.page_limit)
+        for page in range(2, pages + 1):
+            yield self.get_search_request(
+                response.meta['dataset'], callback, page)
+
+    def cut_off(self, response):
+        """Cancels the pages of the search after the page of `response`."""
+        dataset = response.meta['dataset']
+        page = response.meta.get('page', 1)
+        self.search_cutoffs[dataset] = min(
+            page, self.search_cutoffs.get(dataset, page))
+
+    def is_cancelled(self, request):
+        """Called by CancelRequestsMiddleware for each request."""
+        cutoff = self.search_cutoffs.get(request.meta.get('dataset'))
+        return cutoff is not None and request.meta.get('page', 1) > cutoff
+
+    def get_object_request(self, path, dataset, callback, meta=None):
+        """Returns request for the object at `path` with the layers the
+        spider needs, or None when it was already requested or parsed."""
+        path = urlparse(path).path
+        stats = self.crawler.stats
+        if path in self.requested_objects:
+            stats.inc_value('mojepanstwo.pl/objects_coalesced/%s' % dataset)
+            return None
+        self.requested_objects.add(path)
+        stats.inc_value('mojepanstwo.pl/objects_requested/%s' % dataset)
+
+        params = {}
+        if dataset in self.LAYERS:
+            params['layers'] = self.LAYERS[dataset][0]
+        return scrapy.Request(
+            self.get_api_url(path, **params), callback=callback, meta=meta)
+
+    def get_session_request(self, session_id):
+        """Returns request for the session `session_id` unless it was
+        requested in this run or closed in a previous one."""
+        if session_id in self.closed_sessions:
+            self.crawler.stats.inc_value('mojepanstwo.pl/closed_sessions')
+            return None
+        return self.get_object_request(
+            '/dane/%s' % session_id, 'sejm_posiedzenia', self.parse_session)
+
+    def parse_objects(self, response, objects, parse_object, callback):
+        """Parses `objects` found by a search with `parse_object` when the
+        search returned the layers they need, otherwise requests them."""
+        dataset = response.meta['dataset']
+        layer = self.LAYERS[dataset][1]
+        for obj in objects:
+            if layer in (obj.get('layers') or {}):
+                path = urlparse(obj['_id']).path
+                if path not in self.requested_objects:
+                    self.requested_objects.add(path)
+                    self.crawler.stats.inc_value(
+                        'mojepanstwo.pl/objects_from_search/%s' % dataset)
+                    for r in parse_object(obj, {}):
+                        yield r
+            else:
+                req = self.get_object_request(obj['_id'], dataset, callback)
+                if req:
+                    yield req
 
     def parse_people(self, response):
         data = json.loads(response.body_as_unicode())
-        people = data['search']['dataobjects']
-        for person in people:
-            yield scrapy.Request(
-                self.get_api_url(
-                    person['_id'],
-                    layers='info'),
-                callback=self.parse_person
-            )
+        for r in self.parse_objects(
+                response, data['search']['dataobjects'],
+                self.parse_person_object, self.parse_person):
+            yield r
 
-        pagination = data['search']['pagination']
-        if pagination['to'] < pagination['total']:
-            page = response.meta.get('page', 1) + 1
-            yield scrapy.Request(
-                self.get_api_url(
-                    '/dane/dataset/poslowie/search.json',
-                    page=page,
-                    limit=self.page_limit),
-                callback=self.parse_people,
-                meta={'page': page}
-            )
+        for req in self.paginate(
+                response, data['search']['pagination'], self.parse_people):
+            yield req
 
     def parse_person(self, response):
         data = json.loads(response.body_as_unicode())
@@ -100,7 +193,11 @@ class MojepanstwoPlSpider(VisegradSpider):
             else:
                 raise DropItem()
 
-        person = data['object']['data']
+        for r in self.parse_person_object(data['object'], response.meta):
+            yield r
+
+    def parse_person_object(self, obj, meta):
+        person = obj['data']
         l = MojePanstwoPersonLoader(item=Person(),
             scheme='mojepanstwo.pl/people')
         l.add_value('name', person['poslowie.nazwa'])
@@ -118,7 +215,7 @@ class MojepanstwoPlSpider(VisegradSpider):
         # l.add_value('sources', data['object']['_mpurl'])
         l.add_value(
             'sources',
-            'http://mojepanstwo.pl/dane/poslowie/%s' % data['object']['id']
+            'http://mojepanstwo.pl/dane/poslowie/%s' % obj['id']
         )
         gender = person.get('poslowie.plec')
         gender = {
@@ -143,8 +240,7 @@ class MojepanstwoPlSpider(VisegradSpider):
         m.add_value('organization_id', party['identifiers'][0])
         yield m.load_item()
 
-        committees_memberships = data['object']['layers']['info']\
-            ['komisje_stanowiska']
+        committees_memberships = obj['layers']['info']['komisje_stanowiska']
 
         for membership in committees_memberships:
             details = membership['s_poslowie_komisje']
@@ -173,55 +269,94 @@ class MojepanstwoPlSpider(VisegradSpider):
             l.add_value('sources', obj['_mpurl'])
             yield l.load_item()
 
-        pagination = data['search']['pagination']
-        if pagination['to'] < pagination['total']:
-            page = response.meta.get('page', 1) + 1
-            yield scrapy.Request(
-                self.get_api_url(
-                    '/dane/dataset/sejm_komisje/search.json',
-                    page=page,
-                    limit=self.page_limit),
-                callback=self.parse_people,
-                meta={'page': page}
-            )
+        for req in self.paginate(
+                response, data['search']['pagination'], self.parse_committees):
+            yield req
+
+    def iter_search(self, response):
+        """Yields ('pagination', value) and ('object', value) pairs of the
+        search results in `response`. With ijson the results are decoded
+        incrementally, one object at a time, so a page of objects with
+        large layers is never decoded at once."""
+        if ijson is None:
+            search = json.loads(response.body_as_unicode())['search']
+            yield 'pagination', search['pagination']
+            for obj in search['dataobjects']:
+                yield 'object', obj
+            return
+
+        for prefix, value in iter_json_values(
+                response.body, self.SEARCH_PREFIXES):
+            if prefix == 'search.pagination':
+                yield 'pagination', value
+            else:
+                yield 'object', value
 
     def parse_vote_events(self, response):
-        data = json.loads(response.body_as_unicode())
-        vote_events = data['search']['dataobjects']
-
-        stop_date = self.get_latest_vote_event_date()
-
-        for vote_event in vote_events:
+        if self.is_cancelled(response.request):
+            raise StopIteration()
+        stop_date = self.get_stop_date('sejm_glosowania')
+
+        # the objects come with all their votes, see LAYERS
+        for kind, vote_event in self.iter_search(response):
+            if kind == 'pagination':
+                for req in self.paginate(
+                        response, vote_event, self.parse_vote_events):
+                    yield req
+                continue
             dt = vote_event['data'].get('sejm_glosowania.czas')
             if stop_date and dt:
                 dt = datetime.strptime(dt, '%Y-%m-%d %H:%M:%S').date()
                 if dt < stop_date:
+                    self.cut_off(response)
                     raise StopIteration()
-            yield scrapy.Request(
-                self.get_api_url(
-                    vote_event['_id'],
-                    layers='*'),
-                callback=self.parse_vote_event
-            )
-
-        pagination = data['search']['pagination']
-        if pagination['to'] < pagination['total']:
-            page = response.meta.get('page', 1) + 1
-            yield scrapy.Request(
-                self.get_api_url(
-                    '/dane/dataset/sejm_glosowania/search.json',
-                    page=page,
-                    limit=self.page_limit),
-                callback=self.parse_vote_events,
-                meta={'page': page}
-            )
+            for r in self.parse_objects(
+                    response, [vote_event],
+                    self.parse_vote_event_object, self.parse_vote_event):
+                yield r
 
     def parse_vote_event(self, response):
-        data = json.loads(response.body_as_unicode())
-        vote_event = data['object']['data']
+        if ijson is None:
+            data = json.loads(response.body_as_unicode())
+            return self.parse_vote_event_object(data['object'], response.meta)
+        return self.parse_vote_event_stream(response)
+
+    def parse_vote_event_stream(self, response):
+        """Parses the vote event decoding the response incrementally, votes
+        are yielded as they are decoded."""
+        obj = {}
+        votes = []
+        for prefix, value in iter_json_values(
+                response.body, self.VOTE_EVENT_PREFIXES):
+            if prefix != self.VOTES_PREFIX:
+                obj[prefix.split('.')[1]] = value
+                if 'id' in obj and 'data' in obj:
+                    for r in self.parse_vote_event_data(obj):
+                        yield r
+                    for vote in votes:
+                        for r in self.parse_vote(obj, vote):
+                            yield r
+                    votes = None
+            elif votes is None:
+                for r in self.parse_vote(obj, value):
+                    yield r
+            else:
+                # the vote event is not decoded yet
+                votes.append(value)
+
+    def parse_vote_event_object(self, obj, meta):
+        for r in self.parse_vote_event_data(obj):
+            yield r
+        for vote in obj['layers']['wynikiIndywidualne']:
+            for r in self.parse_vote(obj, vote):
+                yield r
+
+    def parse_vote_event_data(self, obj):
+        vote_event = obj['data']
 
-        # link motion and vote event
-        motion_id = str(uuid.uuid4())
+        # link motion and vote event by the id of the vote, which keeps the
+        # motion unchanged between runs
+        motion_id = 'sejm_glosowania/%s' % vote_event['sejm_glosowania.id']
 
         m = MojePanstwoMotionLoader(item=Motion(id=motion_id))
         m.add_value('text', vote_event['sejm_glosowania.tytul'])
@@ -233,17 +368,16 @@ class MojepanstwoPlSpider(VisegradSpider):
         # m.add_value('sources', data['object']['_mpurl'])
         m.add_value(
             'sources',
-            'http://mojepanstwo.pl/dane/sejm_glosowania/%s' % data['object']['id']
+            'http://mojepanstwo.pl/dane/sejm_glosowania/%s' % obj['id']
         )
         motion_item = m.load_item()
         yield motion_item
 
         session_id = motion_item.get('legislative_session_id')
         if session_id:
-            yield scrapy.Request(
-                self.get_api_url('/dane/%s' % session_id),
-                callback=self.parse_session
-            )
+            req = self.get_session_request(session_id)
+            if req:
+                yield req
 
         ve = MojePanstwoVoteEventLoader(item=VoteEvent(motion_id=motion_id))
         ve.add_value('identifier', vote_event['sejm_glosowania.id'])
@@ -261,29 +395,26 @@ class MojepanstwoPlSpider(VisegradSpider):
             Count(option=option, value=value) for option, value in counts.items()
         ]
         ve.add_value('counts', counts)
-        vote_event_item = ve.load_item()
-        yield vote_event_item
-        votes = data['object']['layers']['wynikiIndywidualne']
-        for vote in votes:
-            v = MojePanstwoVoteLoader(
-                item=Vote(),
-                scheme='mojepanstwo.pl/people'
-            )
-            person_id = vote['poslowie']['id']
-            v.add_value('vote_event_id', vote_event_item['identifier'])
-            v.add_value('voter_id', person_id)
-            v.add_value('option', vote['glosy']['glos_id'])
-            yield v.load_item()
-            yield scrapy.Request(
-                self.get_api_url(
-                    '/dane/poslowie/%s' % person_id,
-                    layers='info'),
-                callback=self.parse_person,
-                meta={
-                    'name': vote['poslowie'].get('nazwa'),
-                    'id': person_id
-                }
-            )
+        yield ve.load_item()
+
+    def parse_vote(self, obj, vote):
+        v = MojePanstwoVoteLoader(
+            item=Vote(),
+            scheme='mojepanstwo.pl/people'
+        )
+        person_id = vote['poslowie']['id']
+        v.add_value('vote_event_id', obj['data']['sejm_glosowania.id'])
+        v.add_value('voter_id', person_id)
+        v.add_value('option', vote['glosy']['glos_id'])
+        yield v.load_item()
+        req = self.get_object_request(
+            '/dane/poslowie/%s' % person_id, 'poslowie',
+            self.parse_person, meta={
+                'name': vote['poslowie'].get('nazwa'),
+                'id': person_id
+            })
+        if req:
+            yield req
 
     def parse_session(self, response):
         data = json.loads(response.body_as_unicode())
@@ -295,12 +426,22 @@ class MojepanstwoPlSpider(VisegradSpider):
         l.add_value('start_date', session['sejm_posiedzenia.data_start'])
         l.add_value('end_date', session['sejm_posiedzenia.data_stop'])
         l.add_value('sources', data['object']['_mpurl'])
-        yield l.load_item()
+        item = l.load_item()
+        yield item
+
+        if item.get('end_date') and \
+                item['end_date'][:10] < date.today().isoformat():
+            self.crawl_state.setdefault('closed_sessions', []).append(
+                item['identifier'])
 
     def parse_sittings(self, response):
         data = json.loads(response.body_as_unicode())
         sittings = data['search']['dataobjects']
         for s in sittings:
+            path = urlparse(s['_id']).path
+            if path in self.requested_objects:
+                continue
+            self.requested_objects.add(path)
             sitting = s['data']
             l = MojePanstwoSittingLoader(item=Event(type='sitting'))
             l.add_value('name', sitting['sejm_posiedzenia_punkty.tytul'])
@@ -312,62 +453,49 @@ class MojepanstwoPlSpider(VisegradSpider):
             l.add_value('sources', s['_mpurl'])
             item = l.load_item()
             yield item
-            yield scrapy.Request(
-                self.get_api_url('/dane/%(parent_id)s' % item),
-                callback=self.parse_session
-            )
+            req = self.get_session_request(item['parent_id'])
+            if req:
+                yield req
 
-        pagination = data['search']['pagination']
-        if pagination['to'] < pagination['total']:
-            page = response.meta.get('page', 1) + 1
-            yield scrapy.Request(
-                self.get_api_url(
-                    '/dane/dataset/sejm_posiedzenia_punkty/search.json',
-                    page=page,
-                    limit=self.page_limit),
-                callback=self.parse_sittings,
-                meta={'page': page}
-            )
+        for req in self.paginate(
+                response, data['search']['pagination'], self.parse_sittings):
+            yield req
 
     def parse_speeches(self, response):
+        if self.is_cancelled(response.request):
+            raise StopIteration()
         data = json.loads(response.body_as_unicode())
         speeches = data['search']['dataobjects']
 
-        stop_date = self.get_latest_speech_date()
+        for req in self.paginate(
+                response, data['search']['pagination'], self.parse_speeches):
+            yield req
+
+        stop_date = self.get_stop_date('sejm_wystapienia')
 
         for speech in speeches:
             dt = speech['data']['sejm_wystapienia.data']
             dt = datetime.strptime(dt, '%Y-%m-%d').date()
             if stop_date and dt < stop_date:
+                self.cut_off(response)
                 raise StopIteration()
-            yield scrapy.Request(
-                self.get_api_url(
-                    speech['_id'],
-                    layers='html'),
-                callback=self.parse_speech
-            )
-
-        pagination = data['search']['pagination']
-        if pagination['to'] < pagination['total']:
-            page = response.meta.get('page', 1) + 1
-            yield scrapy.Request(
-                self.get_api_url(
-                    '/dane/dataset/sejm_wystapienia/search.json',
-                    page=page,
-                    limit=self.page_limit),
-                callback=self.parse_speeches,
-                meta={'page': page}
-            )
+            for r in self.parse_objects(
+                    response, [speech],
+                    self.parse_speech_object, self.parse_speech):
+                yield r
 
     def parse_speech(self, response):
         data = json.loads(response.body_as_unicode())
-        speech = data['object']['data']
+        return self.parse_speech_object(data['object'], response.meta)
+
+    def parse_speech_object(self, obj, meta):
+        speech = obj['data']
         l = MojePanstwoSpeechLoader(
             item=Speech(), scheme='mojepanstwo.pl/people')
         l.add_value('title', speech['sejm_wystapienia.tytul'])
         if speech['ludzie.posel_id'] != "0":
             l.add_value('creator_id', speech['ludzie.posel_id'])
-        l.add_value('text', data['object']['layers']['html'])
+        l.add_value('text', obj['layers']['html'])
         l.add_value('date', speech['sejm_wystapienia.data'])
         l.add_value('position', speech.get('sejm_wystapienia._ord'))
         l.add_value('attribution_text', speech.get('stanowiska.nazwa'))
@@ -375,10 +503,9 @@ class MojepanstwoPlSpider(VisegradSpider):
         if speech['sejm_wystapienia.punkt_id'] == '0':
             event_id = pl_make_session_id(
                 speech['sejm_wystapienia.posiedzenie_id'])
-            yield scrapy.Request(
-                self.get_api_url('/dane/%s' % event_id),
-                callback=self.parse_session
-            )
+            req = self.get_session_request(event_id)
+            if req:
+                yield req
         else:
             event_id = pl_make_sitting_id(speech['sejm_wystapienia.punkt_id'])
         l.add_value('event_id', event_id)
@@ -391,7 +518,7 @@ class MojepanstwoPlSpider(VisegradSpider):
         if video == "0":
             video = ""
         l.add_value('video', video)
-        l.add_value('sources', [data['object']['_mpurl']])
+        l.add_value('sources', [obj['_mpurl']])
         yield l.load_item()
 
     def get_api_url(self, path, **params):
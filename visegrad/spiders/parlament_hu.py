@@ -13,14 +13,19 @@ from w3lib.html import remove_tags
 
 import re
 
+import time
+
+import zlib
+
 from visegrad.spiders import VisegradSpider
 from visegrad.items import Person, Vote, VoteEvent, Organization, Membership,\
     Motion, Count, Speech, Event
 from visegrad.loaders import PersonLoader, ParlamentHuVoteLoader, ParlamentHuVoteEventLoader,\
     ParlamentHuOrganizationLoader, ParlamentHuMembershipLoader, ParlamentHuMotionLoader, \
-    CountLoader, ParlamentHuSpeechLoader, ParlamentHuEventLoader
+    ParlamentHuSpeechLoader, ParlamentHuEventLoader
 from visegrad.api.parliaments import ParlamentHuApiExport
-from visegrad.utils import parse_hu_name
+from visegrad.utils import parse_hu_name, iterparse_elements
+from visegrad.selectors import css, xpath, select
 
 
 def get_action_url(url):
@@ -55,6 +60,23 @@ kepviselocsoportjai-es-a-fuggetlen-kepviselok-1990-'
         PERSON_ENDPOINT,
     }
     VOTES_START_DATE = date(2014, 4, 26)
+    # compiled selectors of expressions used for each row of a page
+    VOTE_PAGE_MOTION_LINKS = xpath(
+        "//*[@id='szav-inditvanyok']//tr//td[1]/a/@href")
+    VOTE_PAGE_ROWS = css('#szav-nev-szerint tr')
+    ROW_LINKS = css('a')
+    ROW_HEADERS = css('th')
+    VOTER_LINK = xpath('.//td[1]/a/@href')
+    VOTE_OPTION = xpath('.//td[2]/text()')
+    # (url regex, seconds) pairs, see visegrad.middlewares.PatternPolicy
+    HTTPCACHE_POLICIES = (
+        # committees and party lists of past terms
+        (r'(?i)ogy_biz.*p_ckl=3\d\b', 90 * 24 * 60 * 60),
+        (r'fuggetlen-kepviselok-1990-', 90 * 24 * 60 * 60),
+        # pages of single votes do not change once the vote is over
+        (r'ogy_szav\.szav_lap_egy', 30 * 24 * 60 * 60),
+        (r'web-api/%s' % VOTES_ENDPOINT, 60 * 60),
+    )
 
     PARLIAMENTS_IDENTIFIERS = {
         '2014-': {
@@ -87,11 +109,53 @@ kepviselocsoportjai-es-a-fuggetlen-kepviselok-1990-'
         }
     }
 
+    # number of backfill shards the people and their speeches are split to
+    PEOPLE_SHARDS = 8
+
+    def __init__(self, shard=None, *args, **kwargs):
+        super(ParlamentHu, self).__init__(*args, **kwargs)
+        self.shard = shard
+        self.requested_people = set()
+        # marks of the previous run, the state is updated while crawling
+        self.speech_stop_dates = dict(
+            self.crawl_state.get('speeches', {}))
+
+    @classmethod
+    def get_backfill_shards(cls):
+        """People with their speeches and memberships are split to
+        PEOPLE_SHARDS shards (people-0, ...), votes by years (votes-2014,
+        ...). Votes shards refer to the people only."""
+        years = range(cls.VOTES_START_DATE.year, date.today().year + 1)
+        return ['people-%d' % i for i in range(cls.PEOPLE_SHARDS)] + \
+            ['votes-%d' % y for y in years]
+
     def start_requests(self):
-        yield scrapy.Request(self.PARTIES_URL, callback=self.parse_parties)
-        yield scrapy.Request(self.COMMITTEES_URL, callback=self.parse_commitees)
-        for req in self.get_votes_requests():
-            yield req
+        if self.shard is None:
+            yield scrapy.Request(self.PARTIES_URL, callback=self.parse_parties)
+            yield scrapy.Request(
+                self.COMMITTEES_URL, callback=self.parse_commitees)
+            for req in self.get_votes_requests():
+                yield req
+            return
+
+        kind, _, value = self.shard.partition('-')
+        if kind == 'people':
+            # each people shard lists the people of all terms and crawls its
+            # part of them, see `crawls_person`
+            yield scrapy.Request(self.PARTIES_URL, callback=self.parse_parties)
+            yield scrapy.Request(
+                self.PARTIES_ARCHIVE_URL, callback=self.parse_parties_archive)
+            if value == '0':
+                yield scrapy.Request(
+                    self.COMMITTEES_URL, callback=self.parse_commitees)
+        elif kind == 'votes':
+            year = int(value)
+            for req in self.get_votes_requests(
+                    max(date(year, 1, 1), self.VOTES_START_DATE),
+                    date(year, 12, 31)):
+                yield req
+        else:
+            raise ValueError('Unknown backfill shard %s' % self.shard)
 
     def get_url(self, url):
         for regex in self.API_MAPPINGS:
@@ -176,14 +240,56 @@ kepviselocsoportjai-es-a-fuggetlen-kepviselok-1990-'
         for link in links:
             query = urlparse(link).query
             id = parse_qs(query).get('p_azon')[0]
-            url = self.get_api_url(self.PERSON_ENDPOINT, {'p_azon': id})
-            yield scrapy.Request(
-                url, callback=self.parse_person, meta={'p_azon': id})
+            for req in self.get_person_requests(id):
+                yield req
+
+    def get_person_url(self, p_azon):
+        return 'http://www.parlament.hu/internet/cplsql/ogy_kpv.\
+kepv_adat?p_azon=%s' % p_azon
+
+    def crawls_person(self, p_azon):
+        """Returns whether the person `p_azon` is crawled by this spider, in
+        backfills by exactly one of the people shards."""
+        if self.shard is None:
+            return True
+        kind, _, value = self.shard.partition('-')
+        return kind == 'people' and \
+            zlib.crc32(p_azon) % self.PEOPLE_SHARDS == int(value)
+
+    def get_person_requests(self, p_azon):
+        """Returns requests for the person `p_azon` unless they were
+        already made in this run or another backfill shard crawls the
+        person. The page of the person, which leads to
+        the speeches and memberships, is always requested; the API data
+        is not when crawling the latest data only and it was fetched less
+        than PERSON_CACHE_TTL seconds ago. The person itself is then not
+        scraped, the page has only some of its fields.
+        """
+        if p_azon in self.requested_people or not self.crawls_person(p_azon):
+            return []
+        self.requested_people.add(p_azon)
+
+        fetched = self.crawl_state.get('people', {}).get(p_azon)
+        ttl = settings.getint('PERSON_CACHE_TTL', 0)
+        cached = settings.get('CRAWL_LATEST_ONLY') and fetched and \
+            time.time() - fetched < ttl
+
+        requests = [scrapy.Request(
+            self.get_person_url(p_azon), callback=self.parse_person_details,
+            meta={'p_azon': p_azon, 'person': not cached})]
+        if cached:
+            self.crawler.stats.inc_value('parlament.hu/people_cached')
+        else:
+            requests.append(scrapy.Request(
+                self.get_api_url(self.PERSON_ENDPOINT, {'p_azon': p_azon}),
+                callback=self.parse_person, meta={'p_azon': p_azon}))
+        return requests
 
     def parse_person(self, response):
         l = PersonLoader(item=Person(), response=response,
             scheme='parlament.hu/people')
         pk = response.meta['p_azon']
+        self.crawl_state.setdefault('people', {})[pk] = int(time.time())
         name = response.xpath('//nev/text()').extract()[0]
         splitted_name = parse_hu_name(name)
         if 'given_name' in splitted_name and 'family_name' in splitted_name:
@@ -195,14 +301,10 @@ kepviselocsoportjai-es-a-fuggetlen-kepviselok-1990-'
         l.add_xpath('name', '//nev/text()')
         l.add_xpath('email', '//email/text()')
         l.add_xpath('links', '//honlap/text()')
-        person_url = 'http://www.parlament.hu/internet/cplsql/ogy_kpv.\
-kepv_adat?p_azon=%s' % pk
+        person_url = self.get_person_url(pk)
         l.add_value('sources', [person_url])
         person = l.load_item()
-
-        yield scrapy.Request(
-            person_url, callback=self.parse_person_details,
-            meta={'item': person})
+        yield person
 
         memberships = response.xpath('//kepvcsop-tisztsegek/tisztseg | \
 //kepvcsop-tagsagok/tagsag')
@@ -236,9 +338,11 @@ kepv_adat?p_azon=%s' % pk
             yield l.load_item()
 
     def parse_person_details(self, response):
-        item = response.meta['item']
-        l = PersonLoader(item=item, response=response,
-            response_url=response.url)
+        # fields missing in the API are merged into the person by
+        # MergePipeline
+        l = PersonLoader(item=Person(), response=response,
+            response_url=response.url, scheme='parlament.hu/people')
+        l.add_value('identifiers', response.meta['p_azon'])
         l.add_css('image', 'img.kepviselo-foto::attr(src)')
         person = l.load_item()
 
@@ -295,17 +399,29 @@ kepv_adat?p_azon=%s' % pk
         for speech in speeches_urls:
             yield scrapy.Request(
                 urljoin(response.url, speech),
-                callback=self.parse_person_speeches
+                callback=self.parse_person_speeches,
+                meta={'p_azon': response.meta['p_azon']}
             )
 
-        yield person
+        if response.meta.get('person', True):
+            yield person
 
     def parse_person_speeches(self, response):
         content = response.xpath('//table[3]')
 
         sessions = content.xpath('./tr[1]//table//tr//td[1]//a')
 
-        stop_date = self.get_latest_speech_date()
+        # newest session date of the person's speeches scraped by previous
+        # runs, the listing is sorted from the newest sessions
+        pk = response.meta['p_azon']
+        latest_dates = self.crawl_state.setdefault('speeches', {})
+        stop_date = None
+        if settings.get('CRAWL_LATEST_ONLY'):
+            if pk in self.speech_stop_dates:
+                stop_date = datetime.strptime(
+                    self.speech_stop_dates[pk], '%Y-%m-%d').date()
+            else:
+                stop_date = self.get_latest_speech_date()
 
         for session in sessions:
             dt = session.re(r'\d{4}\.\d{2}.\d{2}')
@@ -313,6 +429,8 @@ kepv_adat?p_azon=%s' % pk
                 dt = datetime.strptime(dt[0], '%Y.%m.%d').date()
                 if stop_date and dt < stop_date:
                     raise StopIteration()
+                if dt.isoformat() > latest_dates.get(pk, ''):
+                    latest_dates[pk] = dt.isoformat()
             url = session.xpath('.//@href').extract()[0]
             yield scrapy.Request(
                 urljoin(response.url, url),
@@ -324,7 +442,8 @@ kepv_adat?p_azon=%s' % pk
         for page in next_page:
             yield scrapy.Request(
                 urljoin(response.url, page),
-                callback=self.parse_person_speeches
+                callback=self.parse_person_speeches,
+                meta={'p_azon': pk}
             )
 
     def parse_session_speeches(self, response):
@@ -400,77 +519,126 @@ kepv_adat?p_azon=%s' % pk
         item = l.load_item()
         yield item
         if 'creator_id' in item:
-            yield scrapy.Request(self.get_api_url(
-                self.PERSON_ENDPOINT, params={
-                    'p_azon': item['creator_id']['identifier']}),
-                callback=self.parse_person, meta={
-                    'p_azon': item['creator_id']['identifier']})
-
-    def get_votes_requests(self):
-        start = date.today() - timedelta(days = 60)
-        end = date.today()
-        get_votes_url = lambda start, end: self.get_api_url(
-            self.VOTES_ENDPOINT, params={
-                'p_datum_tol': start.strftime("%Y.%m.%d"),
-                'p_datum_ig': end.strftime("%Y.%m.%d")
-            })
-
-        stop_date = self.VOTES_START_DATE
+            for req in self.get_person_requests(
+                    item['creator_id']['identifier']):
+                yield req
+
+    def get_votes_requests(self, first_date=None, last_date=None):
+        """Requests the votes in date windows learned by previous runs, see
+        `plan_vote_windows`. The range not covered by them yet is split into
+        windows of VOTES_WINDOW_DAYS days. Backfill shards pass the range of
+        their dates in `first_date` and `last_date`.
+        """
+        window_days = settings.getint('VOTES_WINDOW_DAYS', 60)
+        first_date = first_date or self.VOTES_START_DATE
+        known = self.crawl_state.get('vote_windows', [])
+        windows = self.plan_vote_windows(
+            [(datetime.strptime(start, '%Y-%m-%d').date(),
+              datetime.strptime(end, '%Y-%m-%d').date(), size)
+             for start, end, size in known])
+
+        start = windows[-1][1] + timedelta(days=1) if windows \
+            else first_date
+        while start <= min(last_date or date.today(), date.today()):
+            end = start + timedelta(days=window_days - 1)
+            if last_date:
+                end = min(end, last_date)
+            windows.append((start, end, None))
+            start = end + timedelta(days=1)
+
+        self.crawl_state['vote_windows'] = [
+            [start.isoformat(), end.isoformat(), size]
+            for start, end, size in windows]
+
+        stop_date = first_date
         if settings.get('CRAWL_LATEST_ONLY'):
             stop_date = self.get_latest_vote_event_date() or stop_date
 
-        while start > stop_date:
+        for i, (start, end, size) in reversed(list(enumerate(windows))):
+            if end < stop_date:
+                break
+            # sizes of windows cut by the stop date are not learned
+            index = i if start >= stop_date else None
             yield scrapy.Request(
-                get_votes_url(start, end), callback=self.parse_votes)
-            end = start - timedelta(days = 1)
-            start = end - timedelta(days = 60)
+                self.get_api_url(self.VOTES_ENDPOINT, params={
+                    'p_datum_tol': max(start, stop_date).strftime("%Y.%m.%d"),
+                    'p_datum_ig': min(end, date.today()).strftime("%Y.%m.%d"),
+                }),
+                callback=self.parse_votes, meta={'window': index})
+
+    def plan_vote_windows(self, windows):
+        """Returns `windows` (list of (start, end, size) tuples, size being
+        the length of the last response for the window) with windows larger
+        than VOTES_WINDOW_MAX_SIZE split into even parts and consecutive
+        windows smaller than VOTES_WINDOW_MIN_SIZE merged.
+        """
+        max_size = settings.getint('VOTES_WINDOW_MAX_SIZE')
+        min_size = settings.getint('VOTES_WINDOW_MIN_SIZE')
+
+        plan = []
+        for start, end, size in windows:
+            days = (end - start).days + 1
+            if size is not None and size > max_size and days > 1:
+                parts = min(days, -(-size // max_size))
+                for part in range(parts):
+                    plan.append((
+                        start + timedelta(days=days * part // parts),
+                        start + timedelta(days=days * (part + 1) // parts - 1),
+                        size // parts))
+                continue
 
-        start = stop_date
-        if start <= end:
-            yield scrapy.Request(
-                get_votes_url(start, end), callback=self.parse_votes)
+            if plan and size is not None and plan[-1][2] is not None:
+                prev_start, prev_end, prev_size = plan[-1]
+                if min(size, prev_size) < min_size and \
+                        size + prev_size <= max_size:
+                    plan[-1] = (prev_start, end, prev_size + size)
+                    continue
+            plan.append((start, end, size))
+
+        return plan
 
     def parse_votes(self, response):
+        if response.meta.get('window') is not None:
+            windows = self.crawl_state['vote_windows']
+            windows[response.meta['window']][2] = len(response.body)
+
         VOTE_URL = 'http://www.parlament.hu/internet/cplsql/ogy_szav.szav_lap_egy?\
 p_szavdatum=%s&p_szavkepv=I&p_szavkpvcsop=I&p_ckl=40'
-        for voting in response.xpath('//szavazas'):
-            voting_id = voting.xpath('./@idopont').extract()[0]
-
-            l = ParlamentHuVoteEventLoader(item=VoteEvent(), selector=voting)
-            l.add_xpath('identifier', './@idopont')
-            l.add_xpath('start_date', './@idopont')
-            l.add_xpath('result', u'.//tulajdonsag[@nev="Elfogadás"]/@ertek')
-
-            count_info = (
-                ('yes', u'"Igen"-ek száma'),
-                ('no', u'"Nem"-ek száma'),
-                ('abstain', u'Tartózkodások'),
-            )
+        COUNT_PROPERTIES = (
+            ('yes', u'"Igen"-ek száma'),
+            ('no', u'"Nem"-ek száma'),
+            ('abstain', u'Tartózkodások'),
+        )
+        # the response is parsed incrementally, one szavazas element at
+        # a time
+        for voting in iterparse_elements(response.body, 'szavazas'):
+            voting_id = voting.get('idopont')
+            properties = dict(
+                (p.get('nev'), p.get('ertek'))
+                for p in voting.iter('tulajdonsag'))
+
+            l = ParlamentHuVoteEventLoader(item=VoteEvent())
+            l.add_value('identifier', voting_id)
+            l.add_value('start_date', voting_id)
+            l.add_value('result', properties.get(u'Elfogadás'))
             counts = []
-            for option, tag_attr in count_info:
-                c = CountLoader(item=Count(),
-                    selector=voting.xpath('.//tulajdonsagok'))
-                c.add_value('option', option)
-                xpath = u'.//tulajdonsag[@nev=\'%s\']/@ertek' % tag_attr
-                c.add_xpath('value', xpath)
-                count = c.load_item()
-                if count.get('value'):
-                    counts.append(count)
-
+            for option, name in COUNT_PROPERTIES:
+                value = int(properties.get(name) or 0)
+                if value:
+                    counts.append(Count(option=option, value=value))
             l.add_value('counts', counts)
             l.add_value('sources', VOTE_URL % voting_id)
 
             yield l.load_item()
 
-            motions = voting.xpath('.//inditvanyok/inditvany')
-            for motion in motions:
-                m = ParlamentHuMotionLoader(item=Motion(), selector=motion)
-                m.add_xpath('text', './/cim/text()')
+            for motion in voting.iterfind('.//inditvanyok/inditvany'):
+                m = ParlamentHuMotionLoader(item=Motion())
+                m.add_value('text', [
+                    title.text for title in motion.iterfind('.//cim')
+                    if title.text
+                ])
                 m.add_value(
-                    'requirement',
-                    voting.xpath(
-                        u'.//tulajdonsag[@nev="Szavazási mód"]/@ertek').extract()
-                )
+                    'requirement', properties.get(u'Szavazási mód'))
                 m.add_value('sources', VOTE_URL % voting_id)
                 yield m.load_item()
 
@@ -479,29 +647,27 @@ p_szavdatum=%s&p_szavkepv=I&p_szavkpvcsop=I&p_ckl=40'
                 meta={'voting_id': voting_id})
 
     def parse_vote_page(self, response):
-        motions = response.css(
-            '#szav-inditvanyok tr').xpath('.//td[1]/a/@href').extract()
+        motions = select(response, self.VOTE_PAGE_MOTION_LINKS).extract()
         for m in motions:
             yield scrapy.Request(
                 urljoin(response.url, m), callback=self.parse_motion)
 
         votes = filter(
-            lambda x: x.css('a') and not x.css('th'),
-            response.css('#szav-nev-szerint tr'))
+            lambda x: select(x, self.ROW_LINKS) and
+                not select(x, self.ROW_HEADERS),
+            select(response, self.VOTE_PAGE_ROWS))
         for tr in votes:
             l = ParlamentHuVoteLoader(item=Vote(), selector=tr,
                 scheme='parlament.hu/people')
             l.add_value('vote_event_id', response.meta['voting_id'])
-            l.add_xpath('voter_id', './/td[1]/a/@href',
+            l.add_xpath('voter_id', self.VOTER_LINK,
                         re=r'ogy_kpv\.kepv_adat\?p_azon=(\w\d+)')
-            l.add_xpath('option', './/td[2]/text()')
+            l.add_xpath('option', self.VOTE_OPTION)
             item = l.load_item()
             yield item
-            yield scrapy.Request(self.get_api_url(
-                self.PERSON_ENDPOINT, params={
-                    'p_azon': item['voter_id']['identifier']}),
-                callback=self.parse_person, meta={
-                    'p_azon': item['voter_id']['identifier']})
+            for req in self.get_person_requests(
+                    item['voter_id']['identifier']):
+                yield req
 
     def parse_motion(self, response):
         pass
@@ -3,7 +3,7 @@ import scrapy
 
 import re
 
-from urlparse import urljoin, parse_qs
+from urlparse import urljoin, urlparse, parse_qs
 
 from visegrad.spiders import VisegradSpider
 from visegrad.items import Person, Organization, Membership, Motion, Event,\
@@ -12,6 +12,8 @@ from visegrad.loaders import SkupstinaMePersonLoader, OrganizationLoader, Member
         SkupstinaMeMotionLoader, SkupstinaMeEventLoader,\
         SkupstinaMeSpeechLoader
 from visegrad.api.parliaments import SkustinaMeApiExport
+from visegrad.selectors import css, xpath, select
+from visegrad.utils import content_hash
 
 
 def get_person_id(url):
@@ -24,6 +26,21 @@ def get_person_id(url):
         return search.group('id')
 
 
+def get_sitting_id(url):
+    return parse_qs(urlparse(url).query).get('sjednicaid', [None])[0]
+
+
+def get_font_texts(element):
+    """Returns the text nodes of font elements in `element`, the same as
+    the font::text CSS selector."""
+    texts = []
+    for font in element.iter('font'):
+        if font.text:
+            texts.append(font.text)
+        texts.extend(child.tail for child in font if child.tail)
+    return texts
+
+
 class SkupstinaMeSpider(VisegradSpider):
     name = "skupstina.me"
     allowed_domains = ["www.skupstina.me"]
@@ -42,6 +59,35 @@ index.php?strana=zakoni&search=true'
     SITTINGS_LIST_URL = 'http://www.skupstina.me/~skupcg/skupstina/\
 index.php?strana=sjednice&tipS=0'
     PARLIAMENT_ID = '17'
+    # kinds of rows of the motions list by classes of their cells
+    MOTION_ROW_KINDS = {
+        'poslanici': 'name',
+        'sjednica': 'info',
+    }
+    MOTION_INFO_KEYS = {
+        'status': 'result',
+        'datum': 'date'
+    }
+    MOTION_INFO_KEY_REGEX = re.compile(r'([\w\ ]+):', re.U)
+    # compiled selectors of expressions used for each row of a page
+    SESSION_ROWS = xpath(".//tr[td[@class='poslanici'] or \
+td[@class='sjednica']]")
+    SESSION = css('td.poslanici')
+    SITTING = css('td.sjednica')
+    # (url regex, seconds) pairs, see visegrad.middlewares.PatternPolicy
+    HTTPCACHE_POLICIES = (
+        # sittings may be in progress, closed ones use CLOSED_SITTING_TTL
+        (r'sjednicaid=', 24 * 60 * 60),
+        (r'strana=sjednice', 60 * 60),
+    )
+    # cache lifetime of pages of sittings whose transcript was published
+    CLOSED_SITTING_TTL = 30 * 24 * 60 * 60
+
+    def __init__(self, full_refresh=None, *args, **kwargs):
+        super(SkupstinaMeSpider, self).__init__(*args, **kwargs)
+        # request all the sittings, not only new and changed ones
+        self.full_refresh = bool(full_refresh and full_refresh != '0')
+        self.scraped_sittings = set(self.crawl_state.get('sittings', []))
 
     def make_requests_from_iterable(self, urls, base_url = None, **kwargs):
         for url in urls:
@@ -147,62 +193,65 @@ index.php?strana=sjednice&tipS=0'
             yield req
 
     def parse_motions(self, response):
-        content = response.css('#PretragaZakona')
-
-        motions = []
-        motion_dict = {}
-
-        # very slow and cpu intensive query
-        trs = content.xpath(".//tr[td[contains(@class,'sjednica')]] | \
-.//tr[td[contains(@class,'poslanici')]]")
-
-        for tr in trs:
-            name = tr.css('.poslanici font::text').extract()
-            info = tr.css('.sjednica font::text')
-            if name:
-                # header found, start new item
-                if motion_dict:
-                    motions.append(motion_dict)
-                path = tr.css('a::attr(href)').extract()[0]
-                url = urljoin('http://www.skupstina.me/', path)
-                motion_dict = {
-                    'name': name[0],
-                    'sources': [url]
-                }
-            elif info:
-                key = ''.join(info[0].re(r'([\w\ ]+):')).lower()
-                if key:
-                    value = info[1].extract()
-                    motion_dict[key] = value
+        """Scans the rows of the motions list once. A row with a name starts
+        a new motion, the following info rows hold its details. Each motion
+        is yielded when the next one starts.
+        """
+        motion_dict = None
+        for content in response.css('#PretragaZakona'):
+            for tr in content._root.iter('tr'):
+                texts = {}
+                for td in tr.iterchildren('td'):
+                    for cls in (td.get('class') or '').split():
+                        kind = self.MOTION_ROW_KINDS.get(cls)
+                        if kind:
+                            texts.setdefault(kind, []).extend(
+                                get_font_texts(td))
+
+                if texts.get('name'):
+                    # header found, start new item
+                    if motion_dict:
+                        yield self.load_motion(motion_dict)
+                    path = [a.get('href') for a in tr.iter('a')][0]
+                    motion_dict = {
+                        'name': texts['name'][0],
+                        'sources': [urljoin('http://www.skupstina.me/', path)]
+                    }
+                elif texts.get('info') and motion_dict is not None:
+                    info = texts['info']
+                    key = ''.join(
+                        self.MOTION_INFO_KEY_REGEX.findall(info[0])).lower()
+                    if key and len(info) > 1:
+                        motion_dict[key] = info[1]
         if motion_dict:
-            motions.append(motion_dict)
-
-        keys = {
-            'status': 'result',
-            'datum': 'date'
-        }
-
-        for motion_dict in motions:
-            l = SkupstinaMeMotionLoader(item=Motion())
-            l.add_value('text', motion_dict['name'])
-            l.add_value('sources', motion_dict['sources'])
-            for k in keys:
-                value = motion_dict.get(k)
-                if value:
-                    l.add_value(keys[k], value)
-            yield l.load_item()
+            yield self.load_motion(motion_dict)
+
+    def load_motion(self, motion_dict):
+        l = SkupstinaMeMotionLoader(item=Motion())
+        l.add_value('text', motion_dict['name'])
+        l.add_value('sources', motion_dict['sources'])
+        for k in self.MOTION_INFO_KEYS:
+            value = motion_dict.get(k)
+            if value:
+                l.add_value(self.MOTION_INFO_KEYS[k], value)
+        return l.load_item()
 
     def parse_sessions(self, response):
+        """Requests sittings whose transcript was not scraped by previous
+        runs yet and all the sittings of sessions whose list of sittings has
+        changed since then, or all of them when the spider argument
+        full_refresh is set.
+        """
         content = response.css('.center_content')
         sessions_num = len(content.css('td.poslanici'))
-        rows = content.xpath(".//tr[td[@class='poslanici'] or \
-td[@class='sjednica']]")
+        rows = select(content, self.SESSION_ROWS)
 
-        session_id = None
+        # (session id, [(sitting url, name), ...])
+        sessions = [('', [])]
 
         for row in rows:
-            session = row.css('td.poslanici')
-            sitting = row.css('td.sjednica')
+            session = select(row, self.SESSION)
+            sitting = select(row, self.SITTING)
             if session:
                 session_id = str(sessions_num)
                 sessions_num -= 1
@@ -212,24 +261,37 @@ td[@class='sjednica']]")
                 l.add_value('identifier', session_id)
                 l.add_value('sources', response.url)
                 yield l.load_item()
+                sessions.append((session_id, []))
             elif sitting:
                 url = urljoin(
                     response.url, sitting.xpath('.//@href').extract()[0])
                 name = sitting.css('::text').extract()
+                sessions[-1][1].append((url, name))
+
+        hashes = self.crawl_state.setdefault('session_hashes', {})
+        for session_id, sittings in sessions:
+            digest = content_hash(sittings)
+            changed = self.full_refresh or hashes.get(session_id) != digest
+            hashes[session_id] = digest
+            for url, name in sittings:
+                meta = {
+                    'name': name,
+                    'parent_id': session_id or None
+                }
+                if get_sitting_id(url) in self.scraped_sittings:
+                    if not changed:
+                        self.crawler.stats.inc_value(
+                            'skupstina.me/sittings_skipped')
+                        continue
+                    meta['httpcache_ttl'] = self.CLOSED_SITTING_TTL
                 yield scrapy.Request(
-                    url,
-                    callback=self.parse_sitting,
-                    meta={
-                        'name': name,
-                        'parent_id': session_id
-                    }
-                )
+                    url, callback=self.parse_sitting, meta=meta)
 
     def parse_sitting(self, response):
         content = response.css('.center_content')
         l = SkupstinaMeEventLoader(item=Event(type='sitting'), selector=content)
         l.add_value('name', response.meta['name'])
-        sitting_id = parse_qs(response.url)['sjednicaid']
+        sitting_id = get_sitting_id(response.url)
         l.add_value('identifier', sitting_id)
         l.add_value('parent_id', response.meta['parent_id'])
         l.add_xpath(
@@ -255,3 +317,9 @@ td[@class='sjednica']]")
                 ".//tr[td//text()[contains(., 'Opis')]]/td[2]//text()")
             l.add_value('sources', [urljoin(response.url, url)])
             yield l.load_item()
+
+            # sittings are requested again until their transcript is
+            # published
+            if sitting_id not in self.scraped_sittings:
+                self.scraped_sittings.add(sitting_id)
+                self.crawl_state.setdefault('sittings', []).append(sitting_id)
@@ -0,0 +1,334 @@
+import array
+
+import hashlib
+
+import json
+
+import os
+
+import re
+
+import sqlite3
+
+import struct
+
+from visegrad.utils import open_output, open_input, load_json_file, \
+    save_json_file
+
+
+FINGERPRINT_SIZE = array.array('l').itemsize
+
+COMPACT_VOTES_REGEX = re.compile(r'\.bin(\.\w+)?$')
+
+
+def fingerprint(value):
+    """Returns fixed-width integer fingerprint of the string `value`."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    digest = hashlib.md5(value).digest()
+    if FINGERPRINT_SIZE == 8:
+        return struct.unpack('<q', digest[:8])[0]
+    return struct.unpack('<i', digest[:4])[0]
+
+
+class FingerprintSet(object):
+    """Set of fingerprints kept in a flat open addressing hash table."""
+
+    def __init__(self, capacity=1 << 16):
+        self._table = array.array('l', [0]) * capacity
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def nbytes(self):
+        return len(self._table) * self._table.itemsize
+
+    def add(self, fp):
+        """Adds `fp` to the set and returns True if it was not there."""
+        if fp == 0:  # 0 marks an empty slot
+            fp = 1
+        table = self._table
+        mask = len(table) - 1
+        i = fp & mask
+        while True:
+            slot = table[i]
+            if slot == 0:
+                table[i] = fp
+                self._len += 1
+                if self._len * 3 > len(table) * 2:
+                    self._grow()
+                return True
+            if slot == fp:
+                return False
+            i = (i + 1) & mask
+
+    def _grow(self):
+        old_table = self._table
+        self._table = array.array('l', [0]) * (len(old_table) * 2)
+        self._len = 0
+        for fp in old_table:
+            if fp:
+                self.add(fp)
+
+    def close(self):
+        pass
+
+
+class DiskFingerprintSet(object):
+    """Set of fingerprints stored in a SQLite file, for crawls whose seen
+    items would not fit in memory. The file is recreated on open.
+    """
+    COMMIT_EVERY = 10000
+
+    def __init__(self, filename):
+        self.filename = filename
+        dirs = os.path.dirname(filename)
+        if dirs and not os.path.exists(dirs):
+            os.makedirs(dirs)
+        if os.path.exists(filename):
+            os.remove(filename)
+        self._db = sqlite3.connect(filename)
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute(
+            'CREATE TABLE fingerprints (fp INTEGER PRIMARY KEY)')
+        self._len = 0
+        self._uncommitted = 0
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def nbytes(self):
+        return os.path.getsize(self.filename)
+
+    def add(self, fp):
+        cursor = self._db.execute(
+            'INSERT OR IGNORE INTO fingerprints VALUES (?)', (fp,))
+        if cursor.rowcount != 1:
+            return False
+        self._len += 1
+        self._uncommitted += 1
+        if self._uncommitted >= self.COMMIT_EVERY:
+            self._db.commit()
+            self._uncommitted = 0
+        return True
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+        os.remove(self.filename)
+
+
+class SeenStore(object):
+    """Persistent store of item keys with hashes of their content and the
+    time they were last seen. Items recorded during a run are kept pending
+    until commit(), so a failed run does not hide its items from the next
+    one, and written in batches of `batch_size` rows. Keys not seen by the
+    committed run nor by the previous one are removed.
+    """
+
+    def __init__(self, filename, batch_size=1000):
+        dirs = os.path.dirname(filename)
+        if dirs and not os.path.exists(dirs):
+            os.makedirs(dirs)
+        self._db = sqlite3.connect(filename)
+        for table in ('seen', 'pending'):
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, '
+                'hash TEXT, last_seen INTEGER)' % table)
+        self._db.execute('DELETE FROM pending')
+        self._db.commit()
+        self.batch_size = batch_size
+        self._batch = []
+
+    def get_hash(self, key):
+        row = self._db.execute(
+            'SELECT hash FROM seen WHERE key = ?', (key,)).fetchone()
+        if row:
+            return row[0]
+
+    def add(self, key, digest, timestamp):
+        self._batch.append((key, digest, timestamp))
+        if len(self._batch) >= self.batch_size:
+            self._write_batch()
+
+    def _write_batch(self):
+        self._db.executemany(
+            'INSERT OR REPLACE INTO pending VALUES (?, ?, ?)', self._batch)
+        self._batch = []
+
+    def commit(self):
+        self._write_batch()
+        # all keys of a run are seen at its timestamp
+        previous = self._db.execute(
+            'SELECT MAX(last_seen) FROM seen').fetchone()[0]
+        self._db.execute('INSERT OR REPLACE INTO seen SELECT * FROM pending')
+        if previous is not None:
+            self._db.execute(
+                'DELETE FROM seen WHERE last_seen < ?', (previous,))
+        self._db.execute('DELETE FROM pending')
+        self._db.commit()
+
+    def rollback(self):
+        self._batch = []
+        self._db.execute('DELETE FROM pending')
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+class MergeStore(object):
+    """Keyed store of records which are merged with records added later
+    under the same key. Records are kept in memory up to `memory_limit`
+    keys, the rest is spilled to a SQLite file as JSON.
+    """
+
+    def __init__(self, filename, memory_limit):
+        self.filename = filename
+        self.memory_limit = memory_limit
+        self._memory = {}
+        self._db = None
+
+    def __len__(self):
+        size = len(self._memory)
+        if self._db:
+            cursor = self._db.execute('SELECT COUNT(*) FROM records')
+            size += cursor.fetchone()[0]
+        return size
+
+    def _open_db(self):
+        dirs = os.path.dirname(self.filename)
+        if dirs and not os.path.exists(dirs):
+            os.makedirs(dirs)
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self._db = sqlite3.connect(self.filename)
+        self._db.execute('PRAGMA journal_mode = OFF')
+        self._db.execute('PRAGMA synchronous = OFF')
+        self._db.execute(
+            'CREATE TABLE records (key TEXT PRIMARY KEY, record TEXT)')
+
+    def merge(self, key, record, merge_func):
+        """Stores `record` under `key` or merges it into the stored one
+        using `merge_func(stored, record)`, which returns the result.
+        Spilled records are passed to `merge_func` decoded from JSON.
+        Returns True when no record was stored under `key` yet.
+        """
+        if key in self._memory:
+            self._memory[key] = merge_func(self._memory[key], record)
+            return False
+
+        if self._db is not None:
+            row = self._db.execute(
+                'SELECT record FROM records WHERE key = ?', (key,)).fetchone()
+            if row:
+                merged = merge_func(json.loads(row[0]), record)
+                self._db.execute(
+                    'UPDATE records SET record = ? WHERE key = ?',
+                    (json.dumps(merged), key))
+                return False
+
+        if len(self._memory) < self.memory_limit:
+            self._memory[key] = record
+            return True
+
+        if self._db is None:
+            self._open_db()
+        self._db.execute(
+            'INSERT INTO records VALUES (?, ?)', (key, json.dumps(record)))
+        return True
+
+    def __iter__(self):
+        for key, record in self._memory.iteritems():
+            yield key, record
+        if self._db is not None:
+            for key, record in self._db.execute('SELECT * FROM records'):
+                yield key, json.loads(record)
+
+    def close(self):
+        self._memory = {}
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            os.remove(self.filename)
+
+
+class VoteStore(object):
+    """Compact store of roll-call votes. Vote events, voters and options are
+    interned into tables and each vote is stored as a fixed-width record of
+    indexes into them (0 stands for a missing value). Only votes with no
+    other fields than FIELDS can be stored.
+    """
+    FIELDS = ('vote_event_id', 'voter_id', 'option')
+    RECORD = struct.Struct('<III')
+    RECORDS_PER_READ = 4096
+
+    def __init__(self, filename, tables_filename):
+        self.filename = filename
+        self.tables_filename = tables_filename
+        self.tables = dict((field, []) for field in self.FIELDS)
+        self._indexes = dict((field, {}) for field in self.FIELDS)
+        self._file = None
+        self.count = 0
+
+    def open(self, compression=None, buffer_size=1 << 20):
+        self._file = open_output(self.filename, compression, buffer_size)
+
+    def intern(self, field, value):
+        if value is None:
+            return 0
+        key = json.dumps(value, sort_keys=True)
+        indexes = self._indexes[field]
+        if key not in indexes:
+            self.tables[field].append(value)
+            indexes[key] = len(self.tables[field])
+        return indexes[key]
+
+    def add(self, vote):
+        record = [self.intern(f, vote.get(f)) for f in self.FIELDS]
+        self._file.write(self.RECORD.pack(*record))
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+        save_json_file(self.tables_filename, self.tables)
+
+    def __iter__(self):
+        tables = load_json_file(self.tables_filename)
+        tables = [[None] + tables[field] for field in self.FIELDS]
+        size = self.RECORD.size
+        with open_input(self.filename) as f:
+            while True:
+                data = f.read(size * self.RECORDS_PER_READ)
+                if not data:
+                    break
+                for offset in xrange(0, len(data), size):
+                    record = self.RECORD.unpack_from(data, offset)
+                    vote = {}
+                    for field, table, index in zip(
+                            self.FIELDS, tables, record):
+                        if index:
+                            value = table[index]
+                            if isinstance(value, dict):
+                                value = dict(value)
+                            vote[field] = value
+                    yield vote
+
+
+def load_items(filename):
+    """Yields items of the scraped data file `filename`, either JSON lines
+    or votes of a VoteStore (Vote.bin)."""
+    match = COMPACT_VOTES_REGEX.search(filename)
+    if match:
+        for item in VoteStore(
+                filename, filename[:match.start()] + '.tables.json'):
+            yield item
+        return
+
+    with open_input(filename) as f:
+        for line in f:
+            yield json.loads(line.rstrip())
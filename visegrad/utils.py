@@ -4,6 +4,37 @@ import subprocess
 
 import re
 
+import json
+
+import hashlib
+
+import os
+
+import io
+
+import gzip
+
+from decimal import Decimal
+
+from lxml import etree
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+
+COMPRESSION_EXTENSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
 
 def parse_identifier(identifier, loader_context):
     r = {'identifier': identifier}
@@ -78,3 +109,125 @@ class MakeList(object):
         if type(values) != list:
             values = [values]
         return values
+
+
+def content_hash(value):
+    serialized = json.dumps(value, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(serialized).hexdigest()
+
+
+def load_json_file(filename, default=None):
+    if not os.path.exists(filename):
+        return default
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def save_json_file(filename, data):
+    dirs = os.path.dirname(filename)
+    if dirs and not os.path.exists(dirs):
+        os.makedirs(dirs)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(data, f, sort_keys=True, indent=2)
+    os.rename(tmp_filename, filename)
+
+
+def get_compression_extension(compression):
+    if not compression:
+        return ''
+    if compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError('Unknown compression %r' % compression)
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression requires the zstandard package')
+    return COMPRESSION_EXTENSIONS[compression]
+
+
+def open_output(filename, compression=None,
+                buffer_size=io.DEFAULT_BUFFER_SIZE):
+    """Opens `filename` for writing through a buffer of `buffer_size` bytes,
+    compressed with `compression` ('gzip' or 'zstd') if given.
+    """
+    get_compression_extension(compression)
+    if compression == 'gzip':
+        return io.BufferedWriter(gzip.GzipFile(filename, 'wb'), buffer_size)
+    f = io.open(filename, 'wb', buffering=buffer_size)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().stream_writer(f)
+    return f
+
+
+def find_output_file(filename):
+    """Returns path of `filename` or of its compressed variant, if exists."""
+    for extension in [''] + COMPRESSION_EXTENSIONS.values():
+        if os.path.exists(filename + extension):
+            return filename + extension
+
+
+def remove_output_file(filename):
+    """Removes `filename` and all its compressed variants."""
+    for extension in [''] + COMPRESSION_EXTENSIONS.values():
+        if os.path.exists(filename + extension):
+            os.remove(filename + extension)
+
+
+def open_input(filename):
+    """Opens file written by `open_output` for reading."""
+    if filename.endswith(COMPRESSION_EXTENSIONS['gzip']):
+        return io.BufferedReader(gzip.GzipFile(filename, 'rb'))
+    if filename.endswith(COMPRESSION_EXTENSIONS['zstd']):
+        if zstandard is None:
+            raise ValueError('%s requires the zstandard package' % filename)
+        f = io.open(filename, 'rb')
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f))
+    return io.open(filename, 'rb')
+
+
+def iterparse_elements(body, tag):
+    """Yields `tag` elements of the XML document `body` as soon as they are
+    parsed. Each element is cleared and removed from the tree afterwards,
+    so the memory used does not grow with the size of the document.
+    """
+    context = etree.iterparse(
+        io.BytesIO(body), events=('end',), tag=tag, huge_tree=True)
+    for _, element in context:
+        yield element
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def plain_numbers(value):
+    """Returns `value` decoded by ijson with its Decimal numbers converted
+    to ints and floats, as json.loads returns them."""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() \
+            else float(value)
+    if isinstance(value, dict):
+        return dict((k, plain_numbers(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return map(plain_numbers, value)
+    return value
+
+
+def iter_json_values(body, prefixes):
+    """Yields (prefix, value) pairs of the values at `prefixes` (in ijson
+    notation, e.g. 'object.data' or 'object.votes.item' for each item of
+    the array) of the JSON document `body`, in the order they appear in it.
+    The document is decoded incrementally, only the yielded values are
+    built. Requires the ijson package.
+    """
+    events = ijson.parse(io.BytesIO(body))
+    for prefix, event, value in events:
+        if prefix not in prefixes or event in ('end_map', 'end_array') or \
+                event == 'map_key':
+            continue
+        if event in ('start_map', 'start_array'):
+            builder = ObjectBuilder()
+            end_event = event.replace('start', 'end')
+            current = prefix
+            while (current, event) != (prefix, end_event):
+                builder.event(event, value)
+                current, event, value = next(events)
+            value = builder.value
+        yield prefix, plain_numbers(value)